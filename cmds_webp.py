@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
+import collections
+import hashlib
+import json
 import subprocess
+import tempfile
 import traceback
 import zipfile
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pprint import pprint
 
 import PIL.Image
@@ -15,12 +21,15 @@ import oldezpykit.stdlib.os.common
 import oldezpykit.stdlib.shutil.__deprecated__
 from mylib.easy import logging
 from mylib.ext.console_app import *
+from mylib.ext.PIL import open_bytes_as_image, probe_image_header
+from mylib.ext.tricks import SimpleSQLiteTable
 from mylib.wrapper import cwebp
 
 PIXELS_BASELINE = 1024 * 1024
 MAX_Q = 95
 MIN_Q = 75
 MAX_COMPRESS = 0.7
+IMAGE_PROBE_HEAD_SIZE = 64 * 1024
 
 apr = ArgumentParserWrapper()
 an = apr.an
@@ -33,8 +42,162 @@ class Counter:
     n = 0
 
 
-def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative_to=None, force_convert_webp=False):
+class PipelineMetrics:
+    """thread-safe throughput metrics of the webp pipeline, rates & ETA over a rolling window
+
+    finished tasks are reported by `record` (from the thread collecting the results of worker threads or
+    processes), `status` summarizes them, and with `jsonl_path` every record & status snapshot is dumped
+    as JSON lines. the share of busy seconds spent reading, encoding & writing tells what a run is bound by."""
+    stages = ('read', 'encode', 'write')
+
+    def __init__(self, workers: int, window=30., jsonl_path=None):
+        self.workers = workers
+        self.window = window
+        self.total = 0
+        self.queue_depth = 0
+        self.t0 = time.time()
+        self.recent = collections.deque()
+        self.sums = collections.Counter()
+        self._lock = threading.Lock()
+        self._jsonl = open(jsonl_path, 'a', encoding='utf8') if jsonl_path else None
+        self._reporter_stop = threading.Event()
+        self._reporter = None
+
+    def add_total(self, n: int):
+        with self._lock:
+            self.total += n
+
+    def set_queue_depth(self, n: int):
+        self.queue_depth = n
+
+    def record(self, path, status, encodes, report: dict):
+        now = time.time()
+        # images which went through a webp search, not skipped ones, like `cwebp.CWebpSearchStats`
+        encoded = int(encodes > 0 and status in ('converted', 'modest', 'failed'))
+        entry = {'images': 1, 'encoded': encoded, 'encodes': encodes, 'bytes_in': report.get('bytes_in', 0),
+                 'bytes_out': report.get('bytes_out', 0), 'busy': report.get('busy', 0),
+                 **{k: report.get(k, 0) for k in self.stages}}
+        with self._lock:
+            self.recent.append((now, entry))
+            self.sums.update(entry)
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+            self._dump({'type': 'image', 'time': now, 'path': path, 'status': status, **entry})
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+            window = collections.Counter()
+            for _, entry in self.recent:
+                window.update(entry)
+            sums = collections.Counter(self.sums)
+            total, queue_depth = self.total, self.queue_depth
+        elapsed = now - self.t0
+        span = min(self.window, elapsed) or 1e-9
+        done = sums['images']
+        rate = window['images'] / span
+        busy = sum(window[k] for k in self.stages) or 1e-9
+        return {
+            'type': 'status', 'time': now, 'elapsed': round(elapsed, 3), 'done': done, 'total': total,
+            'images_per_s': round(rate, 3),
+            'bytes_in_per_s': round(window['bytes_in'] / span), 'bytes_out_per_s': round(window['bytes_out'] / span),
+            'encodes_per_image': round(sums['encodes'] / sums['encoded'], 2) if sums['encoded'] else 0,
+            'utilisation': round(min(1., window['busy'] / (span * self.workers)), 3),
+            'queue_depth': queue_depth,
+            'stage_share': {k: round(window[k] / busy, 3) for k in self.stages},
+            'eta': round((total - done) / rate) if rate and total > done else None,
+        }
+
+    def status(self):
+        d = self.snapshot()
+        with self._lock:
+            self._dump(d)
+        eta = naturaldelta(d['eta']) if d['eta'] is not None else '?'
+        share = ', '.join(f'{k} {v:.0%}' for k, v in d['stage_share'].items())
+        return (f"~ {d['done']}/{d['total']}, {d['images_per_s']:.2f} img/s, "
+                f"in {naturalsize(d['bytes_in_per_s'], True)}/s, out {naturalsize(d['bytes_out_per_s'], True)}/s, "
+                f"{d['encodes_per_image']} enc/img, util {d['utilisation']:.0%} ({share}), "
+                f"queue {d['queue_depth']}, eta {eta}")
+
+    def _dump(self, d: dict):
+        # must be called with the lock held
+        if self._jsonl:
+            self._jsonl.write(json.dumps(d, ensure_ascii=False) + '\n')
+            self._jsonl.flush()
+
+    def start_reporter(self, interval: float, print_func=print):
+        """print `status()` every `interval` seconds in a daemon thread, until `close()`"""
+
+        def report():
+            while not self._reporter_stop.wait(interval):
+                print_func(self.status())
+
+        self._reporter = threading.Thread(target=report, daemon=True)
+        self._reporter.start()
+
+    def close(self):
+        self._reporter_stop.set()
+        if self._reporter:
+            self._reporter.join()
+            self._reporter = None
+        with self._lock:
+            if self._jsonl:
+                self._jsonl.close()
+                self._jsonl = None
+
+
+ImageProbe = collections.namedtuple('ImageProbe', ['mime', 'width', 'height'])
+
+
+def probe_image(data: bytes):
+    """mime & dimensions of an image from its file content, only the header is parsed (by PIL if not known)
+
+    `data` may be just the first `IMAGE_PROBE_HEAD_SIZE` bytes, width & height are None if they lie beyond it"""
+    header = probe_image_header(data)
+    if header:
+        return ImageProbe(*header)
+    mime = filetype.guess_mime(data)
+    if mime and mime.startswith('image/'):
+        try:
+            with open_bytes_as_image(data) as img:
+                return ImageProbe(mime, *img.size)
+        except (OSError, ValueError, SyntaxError):
+            pass
+    return ImageProbe(mime, None, None)
+
+
+def adaptive_limits(w, h):
+    """max_size & min_scale of the adaptive webp conversion, by pixels of the image"""
+    pixels = w * h
+    if pixels > PIXELS_BASELINE * 4:
+        max_size = 1024 * 1024
+        min_scale = 0.75
+    elif pixels > PIXELS_BASELINE * 3:
+        max_size = 1024 * 768
+        min_scale = 0.8
+    elif pixels > PIXELS_BASELINE * 2:
+        max_size = 1024 * 512
+        min_scale = 0.9
+    elif pixels > PIXELS_BASELINE:
+        max_size = 1024 * 384
+        min_scale = 1
+    else:
+        max_size = 1024 * 256
+        min_scale = 1
+    return max_size, min_scale
+
+
+def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative_to=None, force_convert_webp=False,
+                     stats: cwebp.CWebpSearchStats = None, backend='cwebp', report: dict = None):
+    """convert an image file to `image_fp + '.webp'`, return (status, webp size or None)
+
+    `report` is filled with bytes in & out and the seconds spent reading, encoding and writing"""
+    report = {} if report is None else report
+
     def _convert_adaptive():
+        t0 = time.perf_counter()
         if print_path_relative_to:
             image_fp_rel = fstk.make_path(image_fp, relative_to=print_path_relative_to)
             if image_fp_rel == '.':
@@ -42,51 +205,57 @@ def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative
         else:
             image_fp_rel = image_fp
         webp_fp = image_fp + '.webp'
-        mime_type, mime_sub = (filetype.guess_mime(image_fp) or '/').split('/')
+        with open(image_fp, 'rb') as fd:
+            image_file_bytes = fd.read(IMAGE_PROBE_HEAD_SIZE)
+            probe = probe_image(image_file_bytes)
+            mime_type, mime_sub = (probe.mime or '/').split('/')
+            if mime_type == 'image' and mime_sub != 'gif' and (mime_sub != 'webp' or force_convert_webp):
+                image_file_bytes += fd.read()
+        report['read'] = report.get('read', 0) + time.perf_counter() - t0
+        report['bytes_in'] = len(image_file_bytes)
         if mime_type != 'image':
             print(f'# skip non-image {image_fp_rel}')
-            return
+            return 'non-image', None
         if mime_sub == 'gif':
             print(f'# skip {mime_sub} image {image_fp_rel}')
-            return
+            return 'gif', None
         if mime_sub == 'webp' and not force_convert_webp:
             print(f'# skip {mime_sub} image {image_fp_rel}')
-            return
+            return 'webp', None
         if counter:
             counter.n += 1
-        img: PIL.Image.Image = PIL.Image.open(image_fp)
-        w, h = img.size
-        pixels = w * h
-        if pixels > PIXELS_BASELINE * 4:
-            max_size = 1024 * 1024
-            min_scale = 0.75
-        elif pixels > PIXELS_BASELINE * 3:
-            max_size = 1024 * 768
-            min_scale = 0.8
-        elif pixels > PIXELS_BASELINE * 2:
-            max_size = 1024 * 512
-            min_scale = 0.9
-        elif pixels > PIXELS_BASELINE:
-            max_size = 1024 * 384
-            min_scale = 1
-        else:
-            max_size = 1024 * 256
-            min_scale = 1
+        if not probe.width:
+            probe = probe_image(image_file_bytes)
+        w, h = probe.width, probe.height
+        if not w:
+            print(f'! (unknown dimensions) {image_fp_rel}')
+            return 'failed', None
+        max_size, min_scale = adaptive_limits(w, h)
         print(f'+ ({w}x{h}, q={MAX_Q}..{MIN_Q}, min_scale={min_scale}, '
               f'max_size={max_size}, max_compress={MAX_COMPRESS}) {image_fp_rel}')
+        t0 = time.perf_counter()
         try:
-            with open(image_fp, 'rb') as fd:
-                image_file_bytes = fd.read()
-            cvt_gen = cwebp.cwebp_adaptive_gen___alpha(image_file_bytes, max_size=max_size, max_compress=MAX_COMPRESS,
-                                                       max_q=MAX_Q, min_q=MIN_Q, min_scale=min_scale)
-            for result in cvt_gen:
-                d_dst = result['dst']
-                print(f"* ({d_dst['width']}x{d_dst['height']}, q={d_dst.get('q', '?')}, scale={d_dst.get('scale', 1)}, "
-                      f"psnr={d_dst['psnr']['all']}, size={d_dst['size']}, compress={d_dst['compress']}) <- {image_fp_rel}")
+            cvt_gen = cwebp.cwebp_adaptive_gen(image_file_bytes, max_size=max_size, max_compress=MAX_COMPRESS,
+                                               max_q=MAX_Q, min_q=MIN_Q, min_scale=min_scale, stats=stats,
+                                               backend=backend, src_dimensions=(w, h))
+            try:
+                for result in cvt_gen:
+                    d_dst = result['dst']
+                    print(f"* ({d_dst['width']}x{d_dst['height']}, q={d_dst.get('q', '?')}, "
+                          f"scale={d_dst.get('scale', 1)}, psnr={d_dst['psnr']['all']}, size={d_dst['size']}, "
+                          f"compress={d_dst['compress']}) <- {image_fp_rel}")
+            finally:
+                # skipped (modest) & failed encodes spend encode time too
+                report['encode'] = report.get('encode', 0) + time.perf_counter() - t0
+            t1 = time.perf_counter()
             with open(webp_fp, 'wb') as f:
                 f.write(result['out'])
+            report['write'] = time.perf_counter() - t1
+            report['bytes_out'] = len(result['out'])
+            return 'converted', len(result['out'])
         except cwebp.SkipOverException as e:
             print(f'# ({e.msg}) {image_fp_rel}')
+            return 'modest', None
         except KeyError as e:
             print(traceback.format_exc())
             print(f'! {image_fp_rel}')
@@ -96,6 +265,7 @@ def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative
         except cwebp.CWebpEncodeError as e:
             if e.reason == e.E.BAD_DIMENSION:
                 print(f'! ({e.reason}) <- {image_fp_rel}')
+                return 'failed', None
             else:
                 print(traceback.format_exc())
                 print(f'! {image_fp_rel}')
@@ -103,6 +273,7 @@ def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative
         except cwebp.CWebpInputReadError as e:
             print(traceback.format_exc())
             print(f'! {image_fp_rel}')
+            return 'failed', None
         # except Exception:
         #     print(traceback.format_exc())
         #     print(f'! {image_fp_rel}')
@@ -119,6 +290,309 @@ def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative
             raise e
 
 
+def _init_convert_worker():
+    ostk.ensure_sigint_signal()
+    PIL.Image.init()
+
+
+def _convert_adaptive_task(image_fp, **kwargs):
+    # counts & stats are per task and merged by the caller, so this works the same in threads & processes
+    counter = Counter()
+    stats = cwebp.CWebpSearchStats()
+    report = {}
+    t0 = time.perf_counter()
+    outcome = convert_adaptive(image_fp, counter=counter, stats=stats, report=report, **kwargs)
+    report['busy'] = time.perf_counter() - t0
+    return counter.n, stats.histogram, outcome, report
+
+
+def _file_size_or_zero(fp):
+    try:
+        return os.path.getsize(fp)
+    except OSError:
+        return 0
+
+
+class MemoryBudget:
+    """blocking byte budget shared by concurrent zip conversions"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int, blocking=True):
+        n = min(n, self.limit)
+        with self._cond:
+            if self.used + n > self.limit:
+                if not blocking:
+                    return False
+                self._cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+            return True
+
+    def release(self, n: int):
+        n = min(n, self.limit)
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+class JobJournal:
+    """append-only JSON lines of finished jobs, keyed by path & size & mtime, to resume an interrupted run"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        d = json.loads(line)
+                    except ValueError:  # torn last line of a killed run
+                        continue
+                    self.done[d['path']] = d
+        self._file = open(path, 'a', encoding='utf8')
+
+    @staticmethod
+    def key(fp):
+        st = os.stat(fp)
+        return os.path.abspath(fp), st.st_size, st.st_mtime_ns
+
+    def is_done(self, fp):
+        try:
+            path, size, mtime = self.key(fp)
+        except OSError:
+            return False
+        d = self.done.get(path)
+        return bool(d) and d['size'] == size and d['mtime'] == mtime
+
+    def add(self, fp, status):
+        path, size, mtime = self.key(fp)
+        d = {'path': path, 'size': size, 'mtime': mtime, 'status': status}
+        with self._lock:
+            self.done[path] = d
+            self._file.write(json.dumps(d, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        os.remove(self.path)
+
+
+class ConversionLedger:
+    """persistent sqlite ledger of the webp conversion outcome of every image & archive
+
+    an entry counts only while the file keeps the same size and mtime, with `digest` a fast content digest
+    (size, head & tail) also finds entries of files renamed or moved since. failed entries are retried.
+    `src_size` is the size before conversion of a file replaced by its converted self, e.g. an archive."""
+    columns = ['path text primary key', 'kind text', 'size integer', 'mtime integer', 'digest text', 'status text',
+               'dst_size integer', 'time real', 'src_size integer']
+    digest_chunk_size = 64 * 1024
+    commit_every = 256
+
+    def __init__(self, db_path: str, digest=False):
+        self.digest = digest
+        self.table = SimpleSQLiteTable(db_path, 'ledger', self.columns, check_same_thread=False)
+        self.table.cursor.execute('create index if not exists ledger_digest on ledger (digest)')
+        existing = [row[1] for row in self.table.cursor.execute('pragma table_info(ledger)')]
+        for c in self.columns[len(existing):]:
+            self.table.cursor.execute(f'alter table ledger add column {c}')
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+
+    def fast_digest(self, fp, size):
+        h = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(fp, 'rb') as f:
+            h.update(f.read(self.digest_chunk_size))
+            if size > self.digest_chunk_size * 2:
+                f.seek(-self.digest_chunk_size, os.SEEK_END)
+            h.update(f.read(self.digest_chunk_size))
+        return h.hexdigest()
+
+    def lookup(self, fp):
+        """the entry dict matching the current file, or None"""
+        try:
+            st = os.stat(fp)
+        except OSError:
+            return None
+        path = os.path.abspath(fp)
+        keys = [c.split()[0] for c in self.columns]
+        with self._lock:
+            rows = self.table.cursor.execute('select * from ledger where path = ?', (path,)).fetchall()
+            if rows and rows[0][2:4] == (st.st_size, st.st_mtime_ns):
+                return dict(zip(keys, rows[0]))
+            if self.digest:
+                digest = self.fast_digest(fp, st.st_size)
+                rows = self.table.cursor.execute('select * from ledger where digest = ?', (digest,)).fetchall()
+                if rows:
+                    return dict(zip(keys, rows[0]))
+        return None
+
+    def is_done(self, fp, force_convert_webp=False):
+        entry = self.lookup(fp)
+        if not entry or entry['status'] == 'failed':
+            return False
+        return not (force_convert_webp and entry['status'] == 'webp')
+
+    def record(self, fp, kind: str, status: str, dst_size: int = None, src_size: int = None):
+        try:
+            st = os.stat(fp)
+        except OSError:
+            return
+        digest = self.fast_digest(fp, st.st_size) if self.digest else None
+        with self._lock:
+            self.table.insert((os.path.abspath(fp), kind, st.st_size, st.st_mtime_ns, digest, status, dst_size,
+                               time.time(), src_size))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.commit()
+
+    def commit(self):
+        self.table.connection.commit()
+        self._uncommitted = 0
+
+    def summary(self):
+        """[(kind, status, count, total size before conversion, total dst_size), ...]"""
+        with self._lock:
+            self.table.cursor.execute('select kind, status, count(*), sum(coalesce(src_size, size)), sum(dst_size) '
+                                      'from ledger group by kind, status')
+            return self.table.cursor.fetchall()
+
+    def log_summary(self, lgr):
+        for kind, status, count, size, dst_size in self.summary():
+            line = f'# ledger: {count} {kind} {status} ({naturalsize(size or 0, True)}'
+            if dst_size:
+                line += f' -> {naturalsize(dst_size, True)}, {dst_size / size:.1%}'
+            lgr.info(line + ')')
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self.table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def convert_image_bytes(data: bytes, name='-', stats: cwebp.CWebpSearchStats = None, backend='cwebp'):
+    """adaptive webp conversion of an image file content, return the webp bytes, or None to keep the original"""
+    probe = probe_image(data)
+    w, h = probe.width, probe.height
+    if not w:
+        print(f'! (unknown dimensions) {name}')
+        return None
+    max_size, min_scale = adaptive_limits(w, h)
+    print(f'+ ({w}x{h}, q={MAX_Q}..{MIN_Q}, min_scale={min_scale}, '
+          f'max_size={max_size}, max_compress={MAX_COMPRESS}) {name}')
+    result = None
+    try:
+        for result in cwebp.cwebp_adaptive_gen(data, max_size=max_size, max_compress=MAX_COMPRESS, max_q=MAX_Q,
+                                               min_q=MIN_Q, min_scale=min_scale, stats=stats, backend=backend,
+                                               src_dimensions=(w, h)):
+            d_dst = result['dst']
+            print(f"* ({d_dst['width']}x{d_dst['height']}, q={d_dst.get('q', '?')}, scale={d_dst.get('scale', 1)}, "
+                  f"psnr={d_dst['psnr']['all']}, size={d_dst['size']}, compress={d_dst['compress']}) <- {name}")
+    except cwebp.SkipOverException as e:
+        print(f'# ({e.msg}) {name}')
+        return None
+    except cwebp.CWebpEncodeError as e:
+        print(f'! ({e.reason}) <- {name}')
+        return None
+    except cwebp.CWebpGenericError:
+        print(traceback.format_exc())
+        print(f'! {name}')
+        return None
+    return result['out'] if result else None
+
+
+def _convert_image_bytes_in_worker(data: bytes, name='-', backend='cwebp'):
+    stats = cwebp.CWebpSearchStats()
+    return convert_image_bytes(data, name, stats=stats, backend=backend), stats.histogram
+
+
+def convert_zip_streaming(src_fp, dst_fp, executor, in_process=False, window=None, force_convert_webp=False,
+                          stats: cwebp.CWebpSearchStats = None, backend='cwebp', flag_filename=None,
+                          memory: 'MemoryBudget' = None, abort: threading.Event = None):
+    """convert images inside zip file `src_fp` into a new zip file `dst_fp`, member by member
+
+    members are read from the source, images are converted by `executor` (a process pool if `in_process`), and
+    written to `dst_fp` in the original order, webp stored without compression, other members copied as is.
+    at most `window` members, and at most the bytes granted by the shared `memory` budget, are held at a time.
+    raise InterruptedError once `abort` is set. return the number of converted images."""
+    window = window or executor._max_workers * 2
+    pending = collections.deque()
+    n = 0
+
+    def new_info(info: zipfile.ZipInfo, filename=None, compress_type=None):
+        r = zipfile.ZipInfo(filename or info.filename, date_time=info.date_time)
+        r.compress_type = info.compress_type if compress_type is None else compress_type
+        r.external_attr = info.external_attr
+        r.comment = info.comment
+        return r
+
+    def write_head():
+        nonlocal n
+        info, data, future = pending.popleft()
+        out = None
+        if future:
+            try:
+                out = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception:
+                print(traceback.format_exc())
+                print(f'! {info.filename}')
+            if in_process and out is not None:
+                out, histogram = out
+                if stats is not None:
+                    stats.update(histogram)
+        if out:
+            zout.writestr(new_info(info, info.filename + '.webp', zipfile.ZIP_STORED), out)
+            n += 1
+        else:
+            zout.writestr(new_info(info), data)
+        if memory:
+            memory.release(len(data))
+
+    with zipfile.ZipFile(src_fp) as zin, zipfile.ZipFile(dst_fp, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            if info.is_dir():
+                zout.writestr(new_info(info), b'')
+                continue
+            if flag_filename and path_basename(info.filename) == flag_filename:
+                continue
+            if abort and abort.is_set():
+                raise InterruptedError(src_fp)
+            if memory and not memory.acquire(info.file_size, blocking=False):
+                # write out what is held before waiting, so that concurrent archives never deadlock on the budget
+                while pending:
+                    write_head()
+                memory.acquire(info.file_size)
+            data = zin.read(info)
+            future = None
+            mime = filetype.guess_mime(data[:512]) or ''
+            if mime.startswith('image/') and mime != 'image/gif' and (mime != 'image/webp' or force_convert_webp):
+                if in_process:
+                    future = executor.submit(_convert_image_bytes_in_worker, data, info.filename, backend=backend)
+                else:
+                    future = executor.submit(convert_image_bytes, data, info.filename, stats=stats, backend=backend)
+            pending.append((info, data, future))
+            while len(pending) >= window:
+                write_head()
+        while pending:
+            write_head()
+        if flag_filename:
+            zout.writestr(flag_filename, b'')
+    return n
+
+
 @apr.sub(apr.rpl_dot, aliases=['cvt.in.zip', 'cvt.zip'])
 @apr.arg(an.src, nargs='*')
 @apr.opt(an.w, an.workdir, default='.')
@@ -127,10 +601,23 @@ def convert_adaptive(image_fp, counter: Counter|None = None, print_path_relative
 @apr.true(an.v, an.verbose)
 @apr.true('f', 'force')
 @apr.opt('k', 'workers', type=int, metavar='N')
+@apr.true('s', 'stream', help='convert zip to zip member by member, without extracting to workdir')
+@apr.true('p', 'processes', help='convert in a process pool (default workers: cpu count) instead of threads')
+@apr.opt('e', 'backend', choices=('cwebp', 'pillow'), default='cwebp',
+         help='webp encoder: cwebp executable, or libwebp in-process via Pillow')
+@apr.opt('a', 'archives', type=int, default=1, metavar='N',
+         help='convert N archives at a time (implies --stream), sharing the image workers')
+@apr.opt('M', 'memory', type=int, default=1024, metavar='MiB', help='cap of zip members held in memory (--stream)')
+@apr.opt('J', 'journal', metavar='FILE', help='journal of finished archives, to resume an interrupted run')
+@apr.opt('L', 'ledger', metavar='FILE', help='sqlite ledger of conversion outcomes, archives done before are skipped')
+@apr.true('D', 'ledger-digest', help='also match ledger entries by a fast content digest (renamed/moved files)')
 @apr.map(an.src, workdir=an.workdir, workers='workers', ext_name=an.extension,
-         strict_mode=an.strict, verbose=an.verbose, force_convert_webp='force')
+         strict_mode=an.strict, verbose=an.verbose, force_convert_webp='force', stream='stream',
+         processes='processes', backend='backend', archives='archives', memory_mb='memory', journal_path='journal',
+         ledger_path='ledger', ledger_digest='ledger_digest')
 def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=False, verbose=False,
-                   force_convert_webp=False,
+                   force_convert_webp=False, stream=False, processes=False, backend='cwebp',
+                   archives=1, memory_mb=1024, journal_path=None, ledger_path=None, ledger_digest=False,
                    fallback_filename_encoding=get_os_default_encoding()):
     """convert non-webp picture inside zip file"""
     flag_filename_of_webp_converted = '__ALREADY_WEBP_CONVERTED__'
@@ -142,17 +629,31 @@ def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=Fa
         files = []
         [files.extend(resolve_path_to_dirs_files(path_join(dp, '**'), glob_recurse=True)[-1]) for dp in dirs]
 
-    for fp in files:
+    executor = None
+    stats = cwebp.CWebpSearchStats()
+
+    def new_executor():
+        if processes:
+            return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_convert_worker)
+        return ThreadPoolExecutor(max_workers=workers or (os.cpu_count() // 3) or os.cpu_count())
+
+    def convert_one(fp):
         need_to_convert = False
         skip = False
 
+        if journal and journal.is_done(fp):
+            lgr.info(f'# skip (journal) {fp}')
+            return
+        if ledger and ledger.is_done(fp):
+            lgr.info(f'# skip (ledger) {fp}')
+            return
         if not fstk.does_file_mime_has(fp, 'zip'):
-            continue
+            return 'not-zip'
 
         with zipfile.ZipFile(fp) as zf:
             if any(map(lambda x: path_basename(x) == flag_filename_of_webp_converted, zf.namelist())):
                 lgr.info(f'# skip {fp}')
-                continue
+                return 'converted-before'
 
             # possible_encodings = []
             # for i in zf.infolist():
@@ -212,24 +713,39 @@ def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=Fa
                             continue
 
             if skip:
-                continue
+                return 'bad-zip'
 
             if not need_to_convert:
-                continue
-            unzip_dir = path_join(workdir, split_path_dir_base_ext(fp)[1]).strip()
-            try:
-                zf.extractall(unzip_dir)
-            except zipfile.BadZipFile:
-                if path_is_dir(unzip_dir):
-                    shutil.rmtree(unzip_dir)
-                continue
+                return 'no-conversion-needed'
+            # a private dir per job, archives of the same name in different folders must not collide
+            stem = split_path_dir_base_ext(fp)[1].strip()
+            job_dir = tempfile.mkdtemp(prefix=f'{stem}.', dir=workdir)
+            unzip_dir = path_join(job_dir, stem)
+            if not stream:
+                try:
+                    zf.extractall(unzip_dir)
+                except zipfile.BadZipFile:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    return 'bad-zip'
 
+        new_zip = unzip_dir + '.zip'
         try:
             old_size = path_size(fp)
-            auto_cvt(unzip_dir, recursive=True, clean=True, cbz=False, workers=workers, verbose=verbose,
-                     force_convert_webp=force_convert_webp)
-            oldezpykit.stdlib.os.common.touch(path_join(unzip_dir, flag_filename_of_webp_converted))
-            new_zip = shutil.make_archive(unzip_dir, 'zip', unzip_dir, verbose=verbose)
+            if stream:
+                try:
+                    convert_zip_streaming(fp, new_zip, executor, in_process=processes,
+                                          force_convert_webp=force_convert_webp, stats=stats, backend=backend,
+                                          flag_filename=flag_filename_of_webp_converted, memory=memory,
+                                          abort=abort)
+                except zipfile.BadZipFile:
+                    return 'bad-zip'
+                except InterruptedError:
+                    return
+            else:
+                auto_cvt(unzip_dir, recursive=True, clean=True, cbz=False, workers=workers, verbose=verbose,
+                         force_convert_webp=force_convert_webp, backend=backend, processes=processes)
+                oldezpykit.stdlib.os.common.touch(path_join(unzip_dir, flag_filename_of_webp_converted))
+                new_zip = shutil.make_archive(unzip_dir, 'zip', unzip_dir, verbose=verbose)
             if ext_name:
                 new_zip = fstk.rename_file_ext(new_zip, ext_name)
                 fp = fstk.rename_file_ext(fp, ext_name)
@@ -239,13 +755,105 @@ def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=Fa
             lgr.info(f'{compress_ratio :.1%} ({naturalsize(new_size, True)} / {naturalsize(old_size, True)})')
             if compress_ratio > MAX_COMPRESS:
                 lgr.info(f'# skip modest size zip file: {fp}')
+                status = 'modest'
+                if ledger:
+                    ledger.record(fp, 'archive', status)
             else:
                 fstk.move_as(new_zip, fp)
                 lgr.info(f'* {fp} <- {new_zip}')
+                status = 'converted'
+                if ledger:
+                    # keyed by the converted archive, so that it is skipped next time
+                    ledger.record(fp, 'archive', status, new_size, old_size)
+            if journal:
+                journal.add(fp, status)
+            return status
         except KeyboardInterrupt:
             sys.exit(2)
         finally:
-            shutil.rmtree(unzip_dir)
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def convert_one_journaled(fp):
+        status = convert_one(fp)
+        if status and status not in ('modest', 'converted'):
+            if journal:
+                journal.add(fp, status)
+            if ledger:
+                ledger.record(fp, 'archive', status)
+
+    if archives > 1:
+        stream = True
+    journal = JobJournal(journal_path) if journal_path else None
+    ledger = ConversionLedger(ledger_path, digest=ledger_digest) if ledger_path else None
+    memory = MemoryBudget(memory_mb * 1024 * 1024) if stream else None
+    abort = threading.Event()
+    if stream:
+        executor = new_executor()
+    try:
+        if archives > 1:
+            # scan, convert & repack several archives at a time, sharing one image worker pool and memory budget
+            with ThreadPoolExecutor(max_workers=archives) as archive_executor:
+                futures = [archive_executor.submit(convert_one_journaled, fp) for fp in files]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException as e:
+                    abort.set()
+                    for future in futures:
+                        future.cancel()
+                    if isinstance(e, KeyboardInterrupt):
+                        sys.exit(2)
+                    raise
+        else:
+            for fp in files:
+                convert_one_journaled(fp)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=abort.is_set())
+            lgr.info(f'# {stats}')
+        if journal:
+            journal.close()
+        if ledger:
+            ledger.log_summary(lgr)
+            ledger.close()
+    if journal:
+        journal.remove()
+
+
+CBZ_STORED_SUFFIXES = ('.webp', '.jpg', '.jpeg', '.png', '.gif', '.avif', '.jxl')
+
+
+def pack_dirs_to_cbz(dirs, delete, workers, lgr):
+    """zip every dir into a sibling .cbz concurrently, then delete the dir in the background
+
+    images are stored without compression, each cbz is written to a temp file and renamed when complete"""
+
+    def delete_dir(dp):
+        try:
+            delete(dp)
+        except OSError:
+            sleep(1)
+            delete(dp)
+        lgr.info(f'- {dp}')
+
+    def pack(dp):
+        cbz_fp = dp + '.cbz'
+        try:
+            fstk.make_zipfile_from_dir(cbz_fp, dp, compression=zipfile.ZIP_DEFLATED,
+                                       stored_suffixes=CBZ_STORED_SUFFIXES, atomic=True)
+        except NotADirectoryError:
+            lgr.info(f'! {dp}')
+            return None
+        lgr.info(f'+ {cbz_fp} <- {dp}')
+        return deleter.submit(delete_dir, dp)
+
+    with ThreadPoolExecutor(max_workers=1) as deleter:
+        with ThreadPoolExecutor(max_workers=workers) as packer:
+            deletions = [packer.submit(pack, dp) for dp in dirs]
+        for future in deletions:
+            deletion = future.result()
+            if deletion:
+                deletion.result()
 
 
 @apr.sub(apr.rpl_dot)
@@ -253,14 +861,28 @@ def convert_in_zip(src, workdir='.', workers=None, ext_name=None, strict_mode=Fa
 @apr.true('c', 'clean')
 @apr.true('z', 'cbz')
 @apr.opt('k', 'workers', type=int, metavar='N')
+@apr.true('p', 'processes', help='convert in a process pool (default workers: cpu count) instead of threads')
 @apr.true(an.B, apr.dst2opt(an.trash_bin), help='delete to trash bin')
 @apr.true('f', 'force')
+@apr.opt('e', 'backend', choices=('cwebp', 'pillow'), default='cwebp',
+         help='webp encoder: cwebp executable, or libwebp in-process via Pillow')
+@apr.opt('L', 'ledger', metavar='FILE', help='sqlite ledger of conversion outcomes, files done before are skipped')
+@apr.true('D', 'ledger-digest', help='also match ledger entries by a fast content digest (renamed/moved files)')
+@apr.opt('i', 'status-interval', type=float, default=10, metavar='SECONDS',
+         help='print a throughput & ETA status line every SECONDS (0 to disable)')
+@apr.opt('m', 'metrics', metavar='FILE', help='append per-image metrics & status snapshots to FILE as JSON lines')
 @apr.arg('src', nargs='*')
 @apr.map('src', recursive='recursive', clean='clean', cbz='cbz', workers='workers', trash_bin=an.trash_bin,
-         force_convert_webp='force')
-def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=False, force_convert_webp=False):
+         force_convert_webp='force', backend='backend', processes='processes', ledger_path='ledger',
+         ledger_digest='ledger_digest', status_interval='status_interval', metrics_path='metrics')
+def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=False, force_convert_webp=False,
+             backend='cwebp', processes=False, ledger_path=None, ledger_digest=False, status_interval=0,
+             metrics_path=None):
     """convert images to webp with auto-clean, auto-compress-to-cbz, adaptive-quality-scale"""
-    workers = workers or (os.cpu_count() // 3) or os.cpu_count()
+    if processes:
+        workers = workers or os.cpu_count()
+    else:
+        workers = workers or (os.cpu_count() // 3) or os.cpu_count()
     lgr = logging.ez_get_logger(auto_cvt.__name__, 'INFO' if verbose else 'ERROR', fmt=logging.LOG_FMT_MESSAGE_ONLY)
     delete = send2trash if trash_bin else oldezpykit.stdlib.shutil.__deprecated__.remove
 
@@ -268,15 +890,63 @@ def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=
     src = dirs + files
     ostk.ensure_sigint_signal()
     cnt = Counter()
+    stats = cwebp.CWebpSearchStats()
     t0 = time.time()
-    lgr.info(f'# workers={workers}')
+    lgr.info(f'# workers={workers}' + (' (processes)' if processes else ''))
+    ledger = ConversionLedger(ledger_path, digest=ledger_digest) if ledger_path else None
+    metrics = PipelineMetrics(workers, jsonl_path=metrics_path)
+    if status_interval:
+        metrics.start_reporter(status_interval)
+    future_fp = {}
+
+    def collect(futures):
+        for future in futures:
+            fp = future_fp.pop(future)
+            e = future.exception()
+            if isinstance(e, BrokenProcessPool):
+                raise e
+            if e:
+                print(''.join(traceback.format_exception(e)))
+                outcome = 'failed', None
+                metrics.record(fp, 'failed', 0, {})
+            else:
+                n, histogram, outcome, report = future.result()
+                cnt.n += n
+                stats.update(histogram)
+                metrics.record(fp, outcome[0] if outcome else None, sum(k * v for k, v in histogram.items()), report)
+            if ledger and outcome:
+                ledger.record(fp, 'image', *outcome)
+
     try:
         for s in src:
             lgr.info(f'@ {s}')
-            with ThreadPoolExecutor(max_workers=workers) as executor:
-                for fp in fstk.find_iter('f', s, recursive=recursive):
-                    executor.submit(convert_adaptive, fp, counter=cnt, print_path_relative_to=s,
-                                    force_convert_webp=force_convert_webp)
+            # biggest images first, so that no long conversion is left alone at the tail
+            files = fstk.find_iter('f', s, recursive=recursive)
+            if ledger:
+                files = [fp for fp in files if not ledger.is_done(fp, force_convert_webp)]
+            files = sorted(files, key=_file_size_or_zero, reverse=True)
+            metrics.add_total(len(files))
+            if processes:
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_convert_worker)
+            else:
+                executor = ThreadPoolExecutor(max_workers=workers)
+            task = partial(_convert_adaptive_task, print_path_relative_to=s, force_convert_webp=force_convert_webp,
+                           backend=backend)
+            with executor:
+                # bounded in-flight tasks, each of which holds at most one whole image in memory
+                pending = set()
+                for fp in files:
+                    if len(pending) >= workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    future = executor.submit(task, fp)
+                    future_fp[future] = fp
+                    pending.add(future)
+                    metrics.set_queue_depth(len(pending))
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                    metrics.set_queue_depth(len(pending))
             if clean:
                 lgr.info('# clean already converted original image files')
                 for fp in fstk.find_iter('f', s, recursive=recursive):
@@ -313,28 +983,26 @@ def auto_cvt(src, recursive, clean, cbz, workers=None, trash_bin=False, verbose=
                             if re.match(r'.+\.(webp|jpg|jpeg|png)', f):
                                 dirs_with_image.append(dp)
                                 break
-                    for dp in dirs_with_image:
-                        cbz_fp = dp + '.cbz'
-                        try:
-                            fstk.make_zipfile_from_dir(cbz_fp, dp)
-                        except NotADirectoryError:
-                            lgr.info(f'! {dp}')
-                        lgr.info(f'+ {cbz_fp} <- {dp}')
-                        try:
-                            delete(dp)
-                        except (OSError, WindowsError):
-                            sleep(1)
-                            delete(dp)
-                        lgr.info(f'- {dp}')
+                    # a sub-dir goes into the cbz of its parent dir
+                    dirs_with_image = [dp for dp in dirs_with_image if not any(
+                        dp.startswith(os.path.join(other, '')) for other in dirs_with_image if other != dp)]
+                    pack_dirs_to_cbz(dirs_with_image, delete, workers, lgr)
     finally:
         t = time.time() - t0
         n = cnt.n
         if verbose:
             cpr.ll()
+        status_line = metrics.status()
+        metrics.close()
         if n:
             lgr.info(f'{n} images in {naturaldelta(t)}, {naturaldelta(t / n)} per image')
+            lgr.info(f'# {stats}')
+            lgr.info(status_line)
         else:
             lgr.info(f'# no image file converted')
+        if ledger:
+            ledger.log_summary(lgr)
+            ledger.close()
 
 
 def main():
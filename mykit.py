@@ -141,9 +141,6 @@ cmd_mode.set_defaults(target=cmd_mode_func)
 
 def merge_zip_files_func():
     from more_itertools import all_equal
-    from fs import open_fs
-    from fs.compress import write_zip
-    from fs.copy import copy_fs_if_newer
     from filetype import guess
 
     def ask_for_dst_path():
@@ -199,11 +196,9 @@ def merge_zip_files_func():
         print(f'@ Merge into ZIP file "{dst}"')
         return
     print(f'* Merge into ZIP file "{dst}"')
-    with open_fs('mem://tmp') as tmp:
-        for s in src_l:
-            with open_fs(f'zip://{s}') as z:
-                copy_fs_if_newer(z, tmp)  # todo: seem check time of ZIP-FS but not files inside
-        write_zip(tmp, dst)
+    counts = fstk.merge_zip_files(src_l, dst, verify=not args.no_verify)
+    print(f'# {counts["members"]} members, {counts["duplicate"]} duplicates skipped, '
+          f'{counts["conflict"]} name conflicts (newest kept)')
     for s in src_l:
         if s == dst:
             continue
@@ -215,6 +210,8 @@ merge_zip_files = add_sub_parser('merge.zip.files', ['mg.zip'], 'merge multiple
 add_dry_run(merge_zip_files)
 merge_zip_files.add_argument('src', nargs='*')
 merge_zip_files.add_argument('-y', '--yes', help='auto confirm yes', action='store_true')
+merge_zip_files.add_argument('--no-verify', action='store_true',
+                             help='treat same-name members of equal size & CRC as duplicates without hashing them')
 
 
 def tag_filter_files_func():
@@ -519,7 +516,7 @@ ffmpeg_img2vid.add_argument('opt', help='ffmpeg options (better insert -- before
 
 
 def ffmpeg_func():
-    from mylib.ffmpeg_alpha import kw_video_convert
+    from mylib.ffmpeg_alpha import KwVideoConvertQueue, ENCODER_SOFTWARE, ENCODER_QSV, ENCODER_NVENC, ENCODER_COPY
     args = rtd.args
     source = args.source or clipboard
     keywords = args.keywords or ()
@@ -534,17 +531,26 @@ def ffmpeg_func():
     opts = args.opts
     if verbose:
         print(args)
+    queue = KwVideoConvertQueue(
+        slots={ENCODER_SOFTWARE: args.jobs, ENCODER_QSV: args.qsv_slots, ENCODER_NVENC: args.nvenc_slots,
+               ENCODER_COPY: args.jobs},
+        threads=args.threads, dry_run=dry_run)
     for filepath in mylib.__deprecated__.list_files(source, recursive=False):
         if verbose:
             print(filepath)
         try:
-            kw_video_convert(
+            queue.add(
                 filepath, keywords=keywords, vf=video_filters, cut_points=cut_points, dest=output_path,
-                overwrite=overwrite, redo=redo_origin, verbose=verbose, dry_run=dry_run, force=force,
-                ffmpeg_opts=opts)
+                overwrite=overwrite, redo=redo_origin, verbose=verbose, force=force, ffmpeg_opts=opts)
         except Exception:
             print(filepath)
             raise
+    try:
+        counts = queue.run()
+    except KeyboardInterrupt:
+        exit(2)
+    if verbose:
+        print(counts)
 
 
 
@@ -560,6 +566,11 @@ ffmpeg.add_argument('-R', '--redo-origin', action='store_true')
 ffmpeg.add_argument('-F', '--force', action='store_true')
 ffmpeg.add_argument('-v', '--verbose', action='count', default=0)
 ffmpeg.add_argument('-D', '--dry-run', action='store_true')
+ffmpeg.add_argument('-j', '--jobs', type=int, default=1, help='concurrent software encodes (and stream copies)')
+ffmpeg.add_argument('--qsv-slots', type=int, default=1, metavar='N', help='concurrent qsv encodes')
+ffmpeg.add_argument('--nvenc-slots', type=int, default=1, metavar='N', help='concurrent nvenc encodes')
+ffmpeg.add_argument('-T', '--threads', type=int, metavar='N',
+                    help='cpu threads budget shared by the software encodes, passed to ffmpeg by -threads')
 ffmpeg.add_argument('opts', nargs='*', help='ffmpeg options (insert -- before opts)')
 
 
@@ -966,6 +977,7 @@ def view_similar_images():
         'hashsize': args.hashsize,
         'trans': args.transpose,
         'dryrun': args.dry_run,
+        'index': args.index,
     }
     dir_l = (p for p in (args.dir or mylib.ext.ostk.clipboard.list_path()) if os.path.isdir(p))
     if dir_l:
@@ -992,6 +1004,13 @@ img_sim_view.add_argument(
     help='do not find similar images for transposed variants (rotated, flipped)')
 img_sim_view.add_argument(
     '-D', '--dry-run', action='store_true', help='find similar images, but without viewing them')
+img_sim_view_index = img_sim_view.add_mutually_exclusive_group()
+img_sim_view_index.add_argument(
+    '-P', '--pairwise', action='store_false', dest='index', default=None,
+    help='always diff every pair of images with the vectorized block scan (default, except for tiny thresholds)')
+img_sim_view_index.add_argument(
+    '-B', '--bk-tree', action='store_true', dest='index', default=None,
+    help='always query a BK-tree index, only faster than the block scan for tiny hamming distances (<=2 bits)')
 
 
 def move_ehviewer_images():
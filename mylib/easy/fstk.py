@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import fnmatch
+import hashlib
 import html
 import json
+import struct
 import urllib.parse
 import zipfile
 from enum import Enum
@@ -275,13 +277,118 @@ def path_parts(path):
     return pp.parts
 
 
-def make_zipfile_from_dir(zip_path, src_dir, *, strip_src_dir=True, **zipfile_kwargs):
+def make_zipfile_from_dir(zip_path, src_dir, *, strip_src_dir=True, stored_suffixes=(), atomic=False,
+                          **zipfile_kwargs):
+    """stored_suffixes: files with these (lowercase) suffixes are stored without compression, e.g. images
+    atomic: write to a temp file beside `zip_path`, then rename it to `zip_path`"""
     src_dir_path = pathlib.Path(src_dir)
     if not os.path.isdir(src_dir_path):
         raise NotADirectoryError(src_dir)
-    with zipfile.ZipFile(zip_path, 'w', **zipfile_kwargs) as zf:
-        for file in src_dir_path.rglob('*'):
-            zf.write(file, file.relative_to(src_dir_path if strip_src_dir else src_dir_path.parent))
+    tmp_path = f'{zip_path}.tmp' if atomic else zip_path
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', **zipfile_kwargs) as zf:
+            for file in src_dir_path.rglob('*'):
+                arcname = file.relative_to(src_dir_path if strip_src_dir else src_dir_path.parent)
+                if file.suffix.lower() in stored_suffixes:
+                    zf.write(file, arcname, compress_type=zipfile.ZIP_STORED)
+                else:
+                    zf.write(file, arcname)
+        if atomic:
+            os.replace(tmp_path, zip_path)
+    except BaseException:
+        if atomic and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def copy_zip_member_raw(zin: zipfile.ZipFile, info: zipfile.ZipInfo, zout: zipfile.ZipFile, chunk_size=1 << 20):
+    """copy a member of `zin` into `zout` as is, the compressed data is neither decompressed nor recompressed"""
+    zin.fp.seek(info.header_offset)
+    fh = zin.fp.read(zipfile.sizeFileHeader)
+    if len(fh) != zipfile.sizeFileHeader or fh[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f'bad local file header of {info.filename}')
+    fh = struct.unpack(zipfile.structFileHeader, fh)
+    zin.fp.seek(fh[zipfile._FH_FILENAME_LENGTH] + fh[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    r = zipfile.ZipInfo(info.filename, info.date_time)
+    for k in ('compress_type', 'comment', 'create_system', 'create_version', 'extract_version', 'reserved',
+              'internal_attr', 'external_attr', 'CRC', 'compress_size', 'file_size'):
+        setattr(r, k, getattr(info, k))
+    r.extra = zipfile._strip_extra(info.extra, (1,))  # zip64 extra is rewritten when needed
+    r.flag_bits = info.flag_bits & ~0x08  # sizes & CRC go into the local header, no data descriptor
+    zip64 = r.file_size > zipfile.ZIP64_LIMIT or r.compress_size > zipfile.ZIP64_LIMIT
+    with zout._lock:
+        zout._writecheck(r)
+        zout._didModify = True
+        zout.fp.seek(zout.start_dir)
+        r.header_offset = zout.fp.tell()
+        zout.fp.write(r.FileHeader(zip64))
+        remaining = info.compress_size
+        while remaining:
+            chunk = zin.fp.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError(info.filename)
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+        zout.start_dir = zout.fp.tell()
+        zout.filelist.append(r)
+        zout.NameToInfo[r.filename] = r
+    return r
+
+
+def zip_member_digest(zf: zipfile.ZipFile, info: zipfile.ZipInfo, chunk_size=1 << 20):
+    h = hashlib.blake2b()
+    with zf.open(info) as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.digest()
+
+
+def merge_zip_files(src_paths: T.Iterable[str], dst_path: str, *, verify=True):
+    """merge zip files into `dst_path` member by member, copying the compressed data as is
+
+    a name found in several sources is kept once: identical members (same size & CRC, and same content digest
+    if `verify`) are skipped, otherwise the newest one wins. memory use does not depend on the archive sizes.
+    `dst_path` may be one of the sources, it is replaced only when the merge is complete.
+    return counts of {'members', 'duplicate', 'conflict'}"""
+    counts = {'members': 0, 'duplicate': 0, 'conflict': 0}
+    tmp_path = f'{dst_path}.tmp'
+    digests = {}
+
+    def digest(zf, info):
+        key = id(zf), info.filename
+        if key not in digests:
+            digests[key] = zip_member_digest(zf, info)
+        return digests[key]
+
+    try:
+        with contextlib.ExitStack() as stack:
+            chosen = {}
+            for p in src_paths:
+                zf = stack.enter_context(zipfile.ZipFile(p))
+                for info in zf.infolist():
+                    prev = chosen.get(info.filename)
+                    if not prev:
+                        chosen[info.filename] = zf, info
+                        continue
+                    prev_zf, prev_info = prev
+                    if (prev_info.file_size, prev_info.CRC) == (info.file_size, info.CRC) and (
+                            not verify or info.is_dir() or digest(prev_zf, prev_info) == digest(zf, info)):
+                        counts['duplicate'] += 1
+                        continue
+                    counts['conflict'] += 1
+                    if info.date_time > prev_info.date_time:
+                        chosen[info.filename] = zf, info
+            with zipfile.ZipFile(tmp_path, 'w') as zout:
+                for zf, info in chosen.values():
+                    copy_zip_member_raw(zf, info, zout)
+            counts['members'] = len(chosen)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return counts
 
 
 class FileSystemError(Exception):
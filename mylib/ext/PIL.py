@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import io
+import struct
 
 from PIL import Image
 from PIL import ImageFile
@@ -29,3 +30,48 @@ def enable_load_truncated_image():
 
 def disable_load_truncated_image():
     ImageFile.LOAD_TRUNCATED_IMAGES = False
+
+
+_JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+
+def probe_image_header(head: bytes):
+    """(mime, width, height) parsed from the first bytes of a PNG/JPEG/GIF/BMP/WebP file without decoding,
+    None if the format is not recognized or the dimensions lie beyond `head`"""
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        w, h = struct.unpack('>II', head[16:24])
+        return 'image/png', w, h
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+        w, h = struct.unpack('<HH', head[6:10])
+        return 'image/gif', w, h
+    if head[:2] == b'BM' and len(head) >= 26:
+        w, h = struct.unpack('<ii', head[18:26])
+        return 'image/bmp', w, abs(h)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            w, h = struct.unpack('<HH', head[26:30])
+            return 'image/webp', w & 0x3fff, h & 0x3fff
+        if chunk == b'VP8L':
+            b = int.from_bytes(head[21:25], 'little')
+            return 'image/webp', (b & 0x3fff) + 1, ((b >> 14) & 0x3fff) + 1
+        if chunk == b'VP8X':
+            return 'image/webp', int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+        return None
+    if head[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 <= len(head):
+            if head[i] != 0xff:
+                return None
+            marker = head[i + 1]
+            if marker == 0xff:  # fill byte
+                i += 1
+                continue
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # stand-alone markers
+                i += 2
+                continue
+            if marker in _JPEG_SOF_MARKERS:
+                h, w = struct.unpack('>HH', head[i + 5:i + 9])
+                return 'image/jpeg', w, h
+            i += 2 + struct.unpack('>H', head[i + 2:i + 4])[0]
+    return None
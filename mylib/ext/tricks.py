@@ -415,13 +415,14 @@ def eval_or_str(x: str):
 
 class SimpleSQLiteTable:
     def __init__(self, db_path: str, table_name: str, table_columns: list or tuple, *,
-                 converters: dict = None, adapters: dict = None):
+                 converters: dict = None, adapters: dict = None, check_same_thread=True):
         logger = logging.ez_get_logger(f'{__name__}.{self.__class__.__name__}')
         db_path = db_path or ':memory:'
         if converters:
-            self.connection = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+            self.connection = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                                              check_same_thread=check_same_thread)
         else:
-            self.connection = sqlite3.connect(db_path)
+            self.connection = sqlite3.connect(db_path, check_same_thread=check_same_thread)
         self.cursor = self.connection.cursor()
         for k, v in (converters or {}).items():
             sqlite3.register_converter(k, v)
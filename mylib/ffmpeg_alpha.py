@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 # encoding=utf8
+import collections
+import json
 import mimetypes
 import random
+import weakref
 from math import log
 
 import ffmpeg
@@ -13,6 +16,7 @@ import mylib.easy.io
 import mylib.ext.tricks
 from mylib.__deprecated__ import fs_find_iter
 from mylib.easy import *
+from mylib.easy import asyncio
 from mylib.easy.filename_tags import EnclosedFilenameTags
 from mylib.easy.logging import ez_get_logger, LOG_FMT_MESSAGE_ONLY
 from mylib.ext import fstk, tui, ostk
@@ -37,6 +41,7 @@ S_NO_SUBTITLE = "no subtitle"
 S_NO_DATA = "no data"
 S_NO_ATTACHMENT = "no attachment"
 S_FIRST_VIDEO = "first video"
+S_PLAN = "plan"
 STREAM_MAP_PRESET_TABLE = {
     S_ALL: ["0"],
     S_ONLY_VIDEO: ["0:V"],
@@ -91,10 +96,325 @@ decorator_choose_map_preset = mylib.easy.deco_factory_param_value_choices(
 )
 
 
+def _number_or_none(x, number_type=float):
+    try:
+        return number_type(x)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProbeFormat(typing.NamedTuple):
+    """container-level fields of an ffprobe result"""
+
+    filename: str
+    format_name: str
+    size: int
+    start_time: float
+    duration: float
+    bit_rate: int
+    tags: dict
+
+    @classmethod
+    def from_probe(cls, d: dict):
+        return cls(
+            filename=d.get("filename"),
+            format_name=d.get("format_name"),
+            size=_number_or_none(d.get("size"), int),
+            start_time=_number_or_none(d.get("start_time")),
+            duration=_number_or_none(d.get("duration")),
+            bit_rate=_number_or_none(d.get("bit_rate"), int),
+            tags=d.get("tags") or {},
+        )
+
+    @property
+    def real_duration(self) -> float:
+        if self.duration is None:
+            raise KeyError("duration")
+        start_time = self.start_time or 0
+        return self.duration if start_time <= 0 else self.duration - start_time
+
+
+class ProbeStream(typing.NamedTuple):
+    """per-stream fields of an ffprobe result, `raw` keeps the whole stream dict"""
+
+    index: int
+    codec_type: str
+    codec_name: str
+    width: int
+    height: int
+    pix_fmt: str
+    start_time: float
+    duration: float
+    attached_pic: bool
+    raw: dict
+
+    @classmethod
+    def from_probe(cls, d: dict):
+        return cls(
+            index=d["index"],
+            codec_type=d.get("codec_type"),
+            codec_name=d.get("codec_name"),
+            width=d.get("width"),
+            height=d.get("height"),
+            pix_fmt=d.get("pix_fmt"),
+            start_time=_number_or_none(d.get("start_time")),
+            duration=_number_or_none(d.get("duration")),
+            attached_pic=bool((d.get("disposition") or {}).get("attached_pic")),
+            raw=d,
+        )
+
+
+class ProbeResult(typing.NamedTuple):
+    """typed view of a full `ffmpeg.probe` result, `raw` is the original dict"""
+
+    format: ProbeFormat
+    streams: typing.List[ProbeStream]
+    raw: dict
+
+    STREAM_TYPES = {
+        "v": "video",
+        "V": "video",
+        "a": "audio",
+        "s": "subtitle",
+        "d": "data",
+        "t": "attachment",
+    }
+
+    @classmethod
+    def from_probe(cls, d: dict):
+        return cls(
+            format=ProbeFormat.from_probe(d.get("format") or {}),
+            streams=[ProbeStream.from_probe(s) for s in d.get("streams") or []],
+            raw=d,
+        )
+
+    def select_streams(self, stream_specifier: str = None) -> typing.List[ProbeStream]:
+        """streams matching a simple ffmpeg stream specifier `<type>[:<n>]`,
+        like `ffprobe -select_streams`,
+        type `V` excludes attached pictures (cover arts)"""
+        if not stream_specifier:
+            return list(self.streams)
+        stream_type, _, n = stream_specifier.partition(":")
+        codec_type = self.STREAM_TYPES[stream_type]
+        selected = [
+            s
+            for s in self.streams
+            if s.codec_type == codec_type
+            and not (stream_type == "V" and s.attached_pic)
+        ]
+        if n:
+            n = int(n)
+            selected = selected[n : n + 1]
+        return selected
+
+
+class FFprobeCache:
+    """memoized `ffmpeg.probe` and `filetype.guess` results,
+    keyed by (absolute path, size, mtime)
+
+    a file that is modified gets probed again. with `db_path`, results also persist
+    in a sqlite table and get reused across runs, since probing spawns a process
+    per file and is slow on network shares."""
+
+    columns = [
+        "path text primary key",
+        "size integer",
+        "mtime integer",
+        "probe text",
+        "mime text",
+    ]
+
+    def __init__(self, db_path: str = None, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.table = None
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if db_path:
+            self.open_store(db_path)
+
+    def open_store(self, db_path: str):
+        with self._lock:
+            if self.table:
+                self.table.close()
+            self.table = mylib.ext.tricks.SimpleSQLiteTable(
+                db_path, "probe", self.columns, check_same_thread=False
+            )
+
+    def close(self):
+        with self._lock:
+            if self.table:
+                self.table.close()
+                self.table = None
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    @staticmethod
+    def file_key(filepath: str) -> tuple | None:
+        """None for what is not a local file (e.g. url), then probed without caching"""
+        try:
+            st = os.stat(filepath)
+        except (OSError, ValueError):
+            return None
+        return os.path.abspath(filepath), st.st_size, st.st_mtime_ns
+
+    def _entry(self, key) -> dict:
+        """cached fields of the file, or an empty dict; call with the lock held"""
+        path, size, mtime = key
+        entry = self._memory.get(path)
+        if entry and entry["key"] == key:
+            self._memory.move_to_end(path)
+            return entry
+        entry = {"key": key}
+        if self.table:
+            row = self.table.cursor.execute(
+                "select size, mtime, probe, mime from probe where path = ?", (path,)
+            ).fetchone()
+            if row and row[:2] == (size, mtime):
+                if row[2] is not None:
+                    entry["probe"] = ProbeResult.from_probe(json.loads(row[2]))
+                if row[3] is not None:
+                    entry["mime"] = row[3]
+        self._memory[path] = entry
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+        return entry
+
+    def _update(self, key, **fields):
+        with self._lock:
+            entry = self._entry(key)
+            entry.update(fields)
+            if self.table:
+                probe_result = entry.get("probe")
+                self.table.insert(
+                    (
+                        *key,
+                        json.dumps(probe_result.raw) if probe_result else None,
+                        entry.get("mime"),
+                    )
+                )
+                self.table.connection.commit()
+
+    def probe(self, filepath: str) -> ProbeResult:
+        key = self.file_key(filepath)
+        if key is None:
+            return ProbeResult.from_probe(ffmpeg.probe(filepath))
+        with self._lock:
+            r = self._entry(key).get("probe")
+        if r is None:
+            r = ProbeResult.from_probe(ffmpeg.probe(filepath))
+            self._update(key, probe=r)
+        return r
+
+    def guess_mime(self, filepath: str) -> str:
+        """mime type sniffed from the file header by `filetype`, empty str if unknown"""
+        key = self.file_key(filepath)
+        if key is None:
+            guess = filetype.guess(filepath)
+            return guess.mime if guess else ""
+        with self._lock:
+            mime = self._entry(key).get("mime")
+        if mime is None:
+            guess = filetype.guess(filepath)
+            mime = guess.mime if guess else ""
+            self._update(key, mime=mime)
+        return mime
+
+    def keyframes(self, filepath: str, stream_specifier: str) -> "KeyframeScan":
+        """keyframes of one stream by a packet scan, memoized in memory only"""
+        key = self.file_key(filepath)
+        if key is None:
+            return KeyframeScan.from_file(filepath, stream_specifier)
+        field = f"keyframes:{stream_specifier}"
+        with self._lock:
+            scan = self._entry(key).get(field)
+        if scan is None:
+            scan = KeyframeScan.from_file(filepath, stream_specifier)
+            self._update(key, **{field: scan})
+        return scan
+
+
+class KeyframeScan(typing.NamedTuple):
+    """keyframes of a stream as (time, byte offset) pairs,
+    the offset counting the stream's packet bytes before that keyframe,
+    `size` is the total packet bytes"""
+
+    keyframes: typing.List[typing.Tuple[float, int]]
+    size: int
+
+    @classmethod
+    def from_file(cls, filepath: str, stream_specifier: str):
+        data = ffmpeg.probe(
+            filepath,
+            select_streams=stream_specifier,
+            show_entries="packet=pts_time,dts_time,size,flags",
+        )
+        keyframes = []
+        offset = 0
+        for packet in data.get("packets") or []:
+            t = _number_or_none(packet.get("pts_time"))
+            if t is None:
+                t = _number_or_none(packet.get("dts_time"))
+            if "K" in packet.get("flags", "") and t is not None:
+                keyframes.append((t, offset))
+            offset += _number_or_none(packet.get("size"), int) or 0
+        keyframes.sort()
+        return cls(keyframes, offset)
+
+
+def plan_balanced_cuts(
+    keyframes: typing.Sequence[typing.Tuple[float, int]],
+    end_time: float,
+    total_size: int,
+    target_duration: float,
+    size_weight: float = 0.5,
+) -> typing.List[int]:
+    """choose keyframes to cut at,
+    so that segments of about `target_duration` have about the same cost,
+    the cost mixing duration and byte size
+    (`size_weight` 0 balances durations only, 1 byte sizes only),
+    return the indexes of the chosen keyframes"""
+    if len(keyframes) < 2:
+        return []
+    start_time = keyframes[0][0]
+    duration = end_time - start_time
+    if duration <= 0:
+        return []
+    if total_size <= 0:
+        size_weight = 0
+    n = max(1, round(duration / target_duration))
+    costs = [
+        (1 - size_weight) * (t - start_time) / duration
+        + (size_weight * offset / total_size if size_weight else 0)
+        for t, offset in keyframes
+    ]
+    cuts = []
+    last = 0  # never cut at the first keyframe
+    j = 1
+    for k in range(1, n):
+        goal = k / n
+        while j < len(costs) and costs[j] < goal:
+            j += 1
+        candidates = [i for i in (j - 1, j) if last < i < len(costs)]
+        if not candidates:
+            break
+        last = min(candidates, key=lambda i: abs(costs[i] - goal))
+        cuts.append(last)
+    return cuts
+
+
+probe_cache = FFprobeCache()
+
+
+def probe(filepath: str) -> ProbeResult:
+    return probe_cache.probe(filepath)
+
+
 def file_is_video(filepath):
-    guess = filetype.guess(filepath)
+    guess = probe_cache.guess_mime(filepath)
     # ext = os.path.splitext(filepath)[-1]
-    if guess and "video" in guess.mime:
+    if "video" in guess:
         return True
     guess = mimetypes.guess_type(filepath)[0]
     if guess and "video" in guess:
@@ -103,9 +423,9 @@ def file_is_video(filepath):
 
 
 def file_is_audio(filepath):
-    guess = filetype.guess(filepath)
+    guess = probe_cache.guess_mime(filepath)
     # ext = os.path.splitext(filepath)[-1]
-    if guess and "audio" in guess.mime:
+    if "audio" in guess:
         return True
     guess = mimetypes.guess_type(filepath)[0]
     if guess and "audio" in guess:
@@ -125,37 +445,37 @@ def filext_from_codec_name(x) -> str:
 
 def excerpt_single_video_stream(filepath: str) -> dict:
     d = {}
-    data = ffmpeg.probe(filepath)
-    file_format = data["format"]
-    streams = data["streams"]
-    if len(streams) == 1:
-        single_stream = streams[0]
-        if (
-            single_stream["codec_type"] == "video"
-            and single_stream["disposition"]["attached_pic"] == 0
-        ):
-            d["size"] = int(file_format["size"])
-            try:
-                d["start_time"] = start_time = float(
-                    single_stream.get("start_time", file_format["start_time"])
-                )
-                duration = float(single_stream.get("duration", file_format["duration"]))
+    r = probe(filepath)
+    if len(r.streams) == 1:
+        single_stream = r.streams[0]
+        if single_stream.codec_type == "video" and not single_stream.attached_pic:
+            d["size"] = r.format.size
+            start_time = single_stream.start_time
+            if start_time is None:
+                start_time = r.format.start_time
+            duration = single_stream.duration
+            if duration is None:
+                duration = r.format.duration
+            if start_time is not None:
+                d["start_time"] = start_time
+            if start_time is None or duration is None:
+                d["duration"] = r.format.duration
+            else:
                 d["duration"] = round((duration - start_time), 6)
-            except KeyError:
-                d["duration"] = float(file_format["duration"])
             d["bit_rate"] = int(8 * d["size"] // d["duration"])
-            d["codec_name"] = single_stream["codec_name"]
-            d["height"] = single_stream["height"]
-            d["width"] = single_stream["width"]
-            d["pix_fmt"] = single_stream["pix_fmt"]
+            d["codec_name"] = single_stream.codec_name
+            d["height"] = single_stream.height
+            d["width"] = single_stream.width
+            d["pix_fmt"] = single_stream.pix_fmt
     return d
 
 
 def get_real_duration(filepath: str) -> float:
-    d = ffmpeg.probe(filepath)["format"]
-    duration = float(d["duration"])
-    start_time = float(d.get("start_time", 0))
-    return duration if start_time <= 0 else duration - start_time
+    return probe(filepath).format.real_duration
+
+
+def get_max_real_duration(filepaths: typing.Iterable[str]) -> float:
+    return max([get_real_duration(f) for f in filepaths])
 
 
 class FFmpegArgsList(list):
@@ -203,10 +523,55 @@ class FFmpegArgsList(list):
         return self
 
 
+class FFmpegCommand(typing.NamedTuple):
+    """immutable ffmpeg command line,
+    `add` returns a new command and leaves this one untouched,
+    so a command can be built and run from any thread or asyncio task"""
+
+    head: tuple = ("ffmpeg",)
+    body: tuple = ()
+    input_bytes: bytes = None  # fed to stdin, e.g. concat list
+
+    def add(self, *args, **kwargs) -> "FFmpegCommand":
+        return self._replace(body=self.body + tuple(FFmpegArgsList(*args, **kwargs)))
+
+    def map_preset(self, map_preset: str) -> "FFmpegCommand":
+        if not map_preset:
+            return self
+        return self.add(map=STREAM_MAP_PRESET_TABLE[map_preset])
+
+    def with_input_bytes(self, input_bytes: bytes) -> "FFmpegCommand":
+        return self._replace(input_bytes=input_bytes)
+
+    @property
+    def args(self) -> list:
+        return [*self.head, *self.body]
+
+
+def _resolve_negative_start_end(input_paths, start, end):
+    if isinstance(start, str):
+        start = mylib.ext.tricks.seconds_from_colon_time(start)
+    if isinstance(end, str):
+        end = mylib.ext.tricks.seconds_from_colon_time(end)
+    if start < 0 or end < 0:
+        max_duration = get_max_real_duration(input_paths)
+        if start < 0:
+            start = max_duration + start
+        if end < 0:
+            end = max_duration + end
+    return start, end
+
+
 class FFmpegRunnerAlpha:
+    """run ffmpeg commands, each method builds its own `FFmpegCommand`,
+    so one runner is safe to share across threads
+
+    `add_args`, `reset_args` and `cmd` are the older stateful way to build a command
+    on the runner itself, which is not thread-safe"""
+
     exe = "ffmpeg"
-    head = FFmpegArgsList(exe)
-    body = FFmpegArgsList()
+    head = (exe,)
+    body = ()
     capture_stdout_stderr = False
 
     class FFmpegError(Exception):
@@ -234,11 +599,12 @@ class FFmpegRunnerAlpha:
     ):
         self.logger = ez_get_logger(f"{__name__}.{self.__class__.__name__}")
         self.capture_stdout_stderr = capture_out_err
+        self.body = FFmpegArgsList()
         self.set_head(banner=banner, loglevel=loglevel, overwrite=overwrite)
 
     @property
     def cmd(self):
-        return self.head + self.body
+        return FFmpegArgsList(self.head, self.body)
 
     def set_head(
         self,
@@ -258,7 +624,11 @@ class FFmpegRunnerAlpha:
             h.add("-n")
         if threads:
             h.add(threads=threads)
-        self.head = h
+        self.head = tuple(h)
+
+    def command(self, *args, **kwargs) -> FFmpegCommand:
+        """a new command starting with this runner's head"""
+        return FFmpegCommand(self.head).add(*args, **kwargs)
 
     def add_args(self, *args, **kwargs):
         self.body.add(*args, **kwargs)
@@ -271,8 +641,8 @@ class FFmpegRunnerAlpha:
             return
         self.add_args(map=STREAM_MAP_PRESET_TABLE[map_preset])
 
-    def proc_comm(self, input_bytes: bytes) -> bytes:
-        cmd = self.cmd
+    def proc_comm(self, input_bytes: bytes, command: FFmpegCommand = None) -> bytes:
+        cmd = command.args if command else self.cmd
         self.logger.info(ostk.shlex_double_quotes_join(cmd))
         if self.capture_stdout_stderr:
             p = subprocess.Popen(
@@ -292,8 +662,10 @@ class FFmpegRunnerAlpha:
                 self.logger.debug(err.decode())
             return out or b""
 
-    def proc_run(self, dry_run: bool = False, **kwargs) -> bytes:
-        cmd = self.cmd
+    def proc_run(
+        self, dry_run: bool = False, command: FFmpegCommand = None, **kwargs
+    ) -> bytes:
+        cmd = command.args if command else self.cmd
         self.logger.info(
             ostk.shlex_double_quotes_join(cmd)
         )  # command list to string with quotes
@@ -314,8 +686,16 @@ class FFmpegRunnerAlpha:
                 self.logger.debug(p.stderr.decode())
             return p.stdout or b""
 
+    def run_command(self, command: FFmpegCommand, dry_run: bool = False) -> bytes:
+        if command.input_bytes is None:
+            return self.proc_run(dry_run=dry_run, command=command)
+        if dry_run:
+            self.logger.info(ostk.shlex_double_quotes_join(command.args))
+            return b""
+        return self.proc_comm(command.input_bytes, command=command)
+
     @decorator_choose_map_preset
-    def concat(
+    def concat_command(
         self,
         input_paths: typing.Iterable[str],
         output_path: str,
@@ -330,53 +710,48 @@ class FFmpegRunnerAlpha:
         map_preset: str = None,
         metadata_file: str = None,
         **output_kwargs,
-    ):
-        if isinstance(start, str):
-            start = mylib.ext.tricks.seconds_from_colon_time(start)
-        if isinstance(end, str):
-            end = mylib.ext.tricks.seconds_from_colon_time(end)
-        if start < 0:
-            start = max([get_real_duration(f) for f in input_paths]) + start
-        if end < 0:
-            end = max([get_real_duration(f) for f in input_paths]) + end
-        self.reset_args()
-        self.add_args(*input_args)
+    ) -> FFmpegCommand:
+        input_paths = list(input_paths)
+        start, end = _resolve_negative_start_end(input_paths, start, end)
+        c = self.command(*input_args)
         if start:
-            self.add_args(ss=start)
+            c = c.add(ss=start)
         input_count = 0
         if concat_demuxer:
             concat_list = None
             for file in input_paths:
                 input_count += 1
-                self.add_args(safe=0, protocol_whitelist="file", f="concat", i=file)
+                c = c.add(safe=0, protocol_whitelist="file", f="concat", i=file)
         else:
             input_count += 1
             concat_list = "\n".join(
                 ["file '{}'".format(e.replace("'", r"'\''")) for e in input_paths]
             )  # ' -> '\''
-            self.add_args(f="concat", safe=0, protocol_whitelist="fd,file,pipe", i="-")
+            c = c.add(f="concat", safe=0, protocol_whitelist="fd,file,pipe", i="-")
         if extra_inputs:
             input_count += len(extra_inputs)
-            self.add_args(i=extra_inputs)
+            c = c.add(i=extra_inputs)
         if metadata_file:
-            self.add_args(i=metadata_file, map_metadata=input_count)
+            c = c.add(i=metadata_file, map_metadata=input_count)
         if end:
-            self.add_args(t=end - start if start else end)
+            c = c.add(t=end - start if start else end)
         if copy_all:
-            self.add_args(c="copy")
+            c = c.add(c="copy")
             if not map_preset:
-                self.add_args(map=range(input_count))
-        self.set_map_preset(map_preset)
-        self.add_args(*output_args, **output_kwargs)
-        self.add_args(output_path)
+                c = c.add(map=range(input_count))
+        c = c.map_preset(map_preset)
+        c = c.add(*output_args, **output_kwargs)
+        c = c.add(output_path)
         if concat_list:
             # print(concat_list)
-            return self.proc_comm(concat_list.encode())
-        else:
-            return self.proc_run()
+            c = c.with_input_bytes(concat_list.encode())
+        return c
+
+    def concat(self, *args, **kwargs):
+        return self.run_command(self.concat_command(*args, **kwargs))
 
     @decorator_choose_map_preset
-    def segment(
+    def segment_command(
         self,
         input_path: str,
         output_path: str = None,
@@ -386,28 +761,29 @@ class FFmpegRunnerAlpha:
         reset_time: bool = True,
         map_preset: str = None,
         **output_kwargs,
-    ):
-        self.reset_args()
+    ) -> FFmpegCommand:
         if not output_path:
             output_path = "%d" + os.path.splitext(input_path)[-1]
-        self.add_args(i=input_path, f="segment")
+        c = self.command(i=input_path, f="segment")
         if copy:
-            self.add_args(c="copy")
+            c = c.add(c="copy")
         if reset_time:
-            self.add_args(reset_timestamps=1)
-        self.set_map_preset(map_preset)
-        self.add_args(*output_args, **output_kwargs)
-        self.add_args(output_path)
-        return self.proc_run()
+            c = c.add(reset_timestamps=1)
+        c = c.map_preset(map_preset)
+        c = c.add(*output_args, **output_kwargs)
+        return c.add(output_path)
+
+    def segment(self, *args, **kwargs):
+        return self.run_command(self.segment_command(*args, **kwargs))
+
+    def metadata_file_command(self, input_path: str, output_path: str) -> FFmpegCommand:
+        return self.command(i=input_path, f="ffmetadata").add(output_path)
 
     def metadata_file(self, input_path: str, output_path: str):
-        self.reset_args()
-        self.add_args(i=input_path, f="ffmetadata")
-        self.add_args(output_path)
-        return self.proc_run()
+        return self.run_command(self.metadata_file_command(input_path, output_path))
 
     @decorator_choose_map_preset
-    def convert(
+    def convert_command(
         self,
         input_paths: typing.Iterable[str],
         output_path: str,
@@ -419,37 +795,31 @@ class FFmpegRunnerAlpha:
         copy_all: bool = False,
         map_preset: str = None,
         metadata_file: str = None,
-        dry_run=False,
         **output_kwargs,
-    ):
-        self.reset_args()
-
-        if isinstance(start, str):
-            start = mylib.ext.tricks.seconds_from_colon_time(start)
-        if isinstance(end, str):
-            end = mylib.ext.tricks.seconds_from_colon_time(end)
-        if start < 0:
-            start = max([get_real_duration(f) for f in input_paths]) + start
-        if end < 0:
-            end = max([get_real_duration(f) for f in input_paths]) + end
+    ) -> FFmpegCommand:
+        input_paths = list(input_paths)
+        start, end = _resolve_negative_start_end(input_paths, start, end)
+        c = self.command()
         if start:
-            self.add_args(ss=start)
+            c = c.add(ss=start)
 
-        self.add_args(*input_args)
-        self.add_args(i=input_paths)
+        c = c.add(*input_args)
+        c = c.add(i=input_paths)
         if metadata_file:
-            self.add_args(i=metadata_file, map_metadata=len(input_paths))
+            c = c.add(i=metadata_file, map_metadata=len(input_paths))
         if end:
-            self.add_args(t=end - start if start else end)
+            c = c.add(t=end - start if start else end)
 
         if copy_all:
-            self.add_args(c="copy")
+            c = c.add(c="copy")
             if not map_preset:
-                self.add_args(map=len(input_paths) - 1)
-        self.set_map_preset(map_preset)
-        self.add_args(*output_args, **output_kwargs)
-        self.add_args(output_path)
-        return self.proc_run(dry_run=dry_run)
+                c = c.add(map=len(input_paths) - 1)
+        c = c.map_preset(map_preset)
+        c = c.add(*output_args, **output_kwargs)
+        return c.add(output_path)
+
+    def convert(self, *args, dry_run=False, **kwargs):
+        return self.run_command(self.convert_command(*args, **kwargs), dry_run=dry_run)
 
     def img2vid(
         self, img_src: str, res_fps: str, vid_path: str, *output_args, **output_kwargs
@@ -469,9 +839,224 @@ class FFmpegRunnerAlpha:
         )
 
 
+def _progress_number(x: str, number_type=float, suffix: str = ""):
+    if x and suffix and x.endswith(suffix):
+        x = x[: -len(suffix)]
+    return _number_or_none(x, number_type)
+
+
+class FFmpegProgress(typing.NamedTuple):
+    """one block of `ffmpeg -progress` output,
+    fields are None when ffmpeg reports N/A"""
+
+    frame: int
+    fps: float
+    bitrate: float  # kbit/s
+    total_size: int
+    out_time: float  # seconds
+    speed: float
+    dup_frames: int
+    drop_frames: int
+    end: bool
+    raw: dict
+
+    @classmethod
+    def from_block(cls, d: dict):
+        out_time_us = _progress_number(d.get("out_time_us"), int)
+        return cls(
+            frame=_progress_number(d.get("frame"), int),
+            fps=_progress_number(d.get("fps")),
+            bitrate=_progress_number(d.get("bitrate"), suffix="kbits/s"),
+            total_size=_progress_number(d.get("total_size"), int),
+            out_time=out_time_us / 1000000 if out_time_us is not None else None,
+            speed=_progress_number(d.get("speed"), suffix="x"),
+            dup_frames=_progress_number(d.get("dup_frames"), int),
+            drop_frames=_progress_number(d.get("drop_frames"), int),
+            end=d.get("progress") == "end",
+            raw=d,
+        )
+
+    def ratio(self, duration: float) -> float | None:
+        """fraction done of an output expected to last `duration` seconds"""
+        if not duration or self.out_time is None:
+            return None
+        return min(1.0, max(0.0, self.out_time / duration))
+
+
+class FFmpegAsyncRunner:
+    """run ffmpeg commands as asyncio subprocesses,
+    parse their `-progress pipe:1` output into `FFmpegProgress`
+
+    concurrent runs in the same event loop are limited by `concurrency`.
+    a run whose output time does not advance for `stall_timeout` seconds is killed
+    and raises `FFmpegStalled`. cancelling the awaiting task terminates the process.
+    commands must not write their output to stdout, which carries the progress."""
+
+    progress_args = ("-progress", "pipe:1", "-nostats")
+    stderr_tail_lines = 100
+    terminate_timeout = 5
+
+    class FFmpegStalled(FFmpegRunnerAlpha.FFmpegError):
+        pass
+
+    def __init__(
+        self,
+        runner: FFmpegRunnerAlpha = None,
+        concurrency: int = None,
+        stall_timeout: float = None,
+    ):
+        self.runner = runner or FFmpegRunnerAlpha(banner=False)
+        self.logger = self.runner.logger
+        self.concurrency = concurrency
+        self.stall_timeout = stall_timeout
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self):
+        # a semaphore is bound to the loop it is first used in,
+        # so keep one per loop, e.g. for every `run_sync` call
+        if not self.concurrency:
+            return None
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    async def _terminate(self, proc):
+        if proc.returncode is not None:
+            return
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), self.terminate_timeout)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def run(
+        self, command: FFmpegCommand, on_progress=None, dry_run=False
+    ) -> FFmpegProgress | None:
+        """run the command, call `on_progress(progress)` on every progress block,
+        `on_progress` may be a function or a coroutine function,
+        return the last progress, raise `FFmpegError` if ffmpeg failed"""
+        semaphore = self._get_semaphore()
+        if semaphore:
+            async with semaphore:
+                return await self._run(command, on_progress, dry_run)
+        return await self._run(command, on_progress, dry_run)
+
+    async def _run(self, command: FFmpegCommand, on_progress, dry_run):
+        cmd = [*command.head, *self.progress_args, *command.body]
+        self.logger.info(ostk.shlex_double_quotes_join(cmd))
+        if dry_run:
+            return None
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=(
+                subprocess.PIPE
+                if command.input_bytes is not None
+                else subprocess.DEVNULL
+            ),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stderr_tail = collections.deque(maxlen=self.stderr_tail_lines)
+
+        async def feed_stdin():
+            try:
+                proc.stdin.write(command.input_bytes)
+                await proc.stdin.drain()
+                proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        async def read_stderr():
+            async for line in proc.stderr:
+                stderr_tail.append(line.decode(errors="replace").rstrip("\r\n"))
+
+        side_tasks = [asyncio.ensure_future(read_stderr())]
+        if command.input_bytes is not None:
+            side_tasks.append(asyncio.ensure_future(feed_stdin()))
+        loop = asyncio.get_running_loop()
+        last_progress = None
+        last_out_time = None
+        last_advance = loop.time()
+        block = {}
+        try:
+            while True:
+                if self.stall_timeout:
+                    timeout = last_advance + self.stall_timeout - loop.time()
+                    try:
+                        line = await asyncio.wait_for(
+                            proc.stdout.readline(), max(timeout, 0)
+                        )
+                    except asyncio.TimeoutError:
+                        await self._terminate(proc)
+                        raise self.FFmpegStalled(
+                            -1,
+                            f"no progress in {self.stall_timeout}s\n"
+                            + "\n".join(stderr_tail),
+                        )
+                else:
+                    line = await proc.stdout.readline()
+                if not line:
+                    break
+                key, _, value = line.decode(errors="replace").strip().partition("=")
+                block[key] = value
+                if key != "progress":
+                    continue
+                last_progress = FFmpegProgress.from_block(block)
+                block = {}
+                if last_progress.out_time is not None and (
+                    last_out_time is None or last_progress.out_time > last_out_time
+                ):
+                    last_out_time = last_progress.out_time
+                    last_advance = loop.time()
+                if on_progress:
+                    r = on_progress(last_progress)
+                    if asyncio.iscoroutine(r):
+                        await r
+            code = await proc.wait()
+            await asyncio.gather(*side_tasks)
+        except BaseException:
+            for t in side_tasks:
+                t.cancel()
+            await self._terminate(proc)
+            raise
+        if code:
+            raise self.runner.FFmpegError(
+                code, "\n".join(stderr_tail) or "<error not captured>"
+            )
+        if stderr_tail:
+            self.logger.debug("\n".join(stderr_tail))
+        return last_progress
+
+    async def run_many(
+        self, commands: typing.Iterable[FFmpegCommand], on_progress=None
+    ) -> list:
+        """run commands concurrently (up to `concurrency`),
+        `on_progress(index, progress)` tells them apart,
+        return each one's last progress or exception in the order given"""
+
+        def progress_callback(i):
+            if on_progress:
+                return lambda p: on_progress(i, p)
+
+        return await asyncio.gather(
+            *[self.run(c, progress_callback(i)) for i, c in enumerate(commands)],
+            return_exceptions=True,
+        )
+
+    def run_sync(
+        self, commands: typing.Iterable[FFmpegCommand], on_progress=None
+    ) -> list:
+        return asyncio.run(self.run_many(commands, on_progress))
+
+
 def get_width_height(filepath) -> (int, int):
-    d = ffmpeg.probe(filepath, select_streams="V")["streams"][0]
-    return d["width"], d["height"]
+    d = probe(filepath).select_streams("V")[0]
+    return d.width, d.height
 
 
 @mylib.easy.deco_factory_param_value_choices(
@@ -546,7 +1131,42 @@ def get_filter_str(filters):
     return ",".join(get_filter_list(filters))
 
 
-def kw_video_convert(
+ENCODER_SOFTWARE = "software"
+ENCODER_QSV = "qsv"
+ENCODER_NVENC = "nvenc"
+ENCODER_COPY = "copy"
+ENCODER_CLASSES = (ENCODER_SOFTWARE, ENCODER_QSV, ENCODER_NVENC, ENCODER_COPY)
+
+
+class KwVideoConvertJob(typing.NamedTuple):
+    """a planned `kw_video_convert`,
+    with every probe, tag decision and skip rule already applied"""
+
+    filepath: str
+    output_path: str
+    # where the source file is moved after success, None to leave it in place
+    origin_path: str
+    input_args: FFmpegArgsList
+    output_args: FFmpegArgsList
+    start: float | int | str
+    end: float | int | str
+    keywords: set
+    encoder: str  # one of ENCODER_CLASSES
+    size: int
+    verbose: int
+    kwargs: dict
+
+
+def _verbose_log_level(verbose: int) -> str:
+    if verbose > 1:
+        return "DEBUG"
+    elif verbose > 0:
+        return "INFO"
+    else:
+        return "WARNING"
+
+
+def plan_kw_video_convert(
     filepath,
     keywords=(),
     vf=None,
@@ -555,18 +1175,11 @@ def kw_video_convert(
     redo=False,
     ffmpeg_opts=(),
     verbose=0,
-    dry_run=False,
     force=False,
     **kwargs,
-):
-    ff = FFmpegRunnerAlpha(overwrite=True, banner=False)
-    if verbose > 1:
-        lvl = "DEBUG"
-    elif verbose > 0:
-        lvl = "INFO"
-    else:
-        lvl = "WARNING"
-    ff.logger.setLevel(lvl)
+) -> KwVideoConvertJob | None:
+    """decide how `kw_video_convert` would convert the file,
+    return None if it would be skipped"""
     vf_list = get_filter_list(vf)
     vf_str = get_filter_str(vf_list)
     ffmpeg_input_args = FFmpegArgsList()
@@ -604,10 +1217,21 @@ def kw_video_convert(
             logger.info(f"# skip non-video-audio\n {filepath}")
             return
 
-    ft = filetype.guess(filepath)
-    if ft and ft.mime == "image/vnd.adobe.photoshop":
-        ff.convert([filepath], filepath + ".png")
-        return
+    if probe_cache.guess_mime(filepath) == "image/vnd.adobe.photoshop":
+        return KwVideoConvertJob(
+            filepath,
+            filepath + ".png",
+            None,
+            FFmpegArgsList(),
+            FFmpegArgsList(),
+            0,
+            0,
+            set(keywords),
+            ENCODER_SOFTWARE,
+            os.path.getsize(filepath),
+            verbose,
+            {},
+        )
 
     if "10bit" in keywords:
         ffmpeg_output_args = FFmpegArgsList(pix_fmt="yuv420p10le")
@@ -697,7 +1321,7 @@ def kw_video_convert(
         try:
             w, h = get_width_height(filepath)
         except IndexError:
-            ff.logger.info(f"# no video stream: {filepath}")
+            logger.info(f"# no video stream: {filepath}")
             return
         new_vf = get_vf_res_scale_down(w, h, res_limit, vf=vf_str, flags=scale_flags)
         if "cuda" in keywords and allow_cuda:
@@ -773,6 +1397,15 @@ def kw_video_convert(
         ffmpeg_output_args.add_kwarg("-x265-params", "aq-mode=3")
     ffmpeg_output_args.add(ffmpeg_opts)
 
+    if keywords & {"copy", "vcopy"}:
+        encoder = ENCODER_COPY
+    elif codec.endswith("q"):
+        encoder = ENCODER_QSV
+    elif codec.endswith("nv"):
+        encoder = ENCODER_NVENC
+    else:
+        encoder = ENCODER_SOFTWARE
+
     if keywords & {"copy", "vcopy"}:
         tags.append("copy")
     elif keywords & {"m4a", "aac"}:
@@ -841,6 +1474,37 @@ def kw_video_convert(
         return
     logger.info(f"* {tags}\n  {filepath}")
     lp.l()
+    return KwVideoConvertJob(
+        filepath,
+        output_path,
+        origin_path,
+        ffmpeg_input_args,
+        ffmpeg_output_args,
+        start,
+        end,
+        keywords,
+        encoder,
+        os.path.getsize(filepath),
+        verbose,
+        kwargs,
+    )
+
+
+def run_kw_video_convert_job(
+    job: KwVideoConvertJob, threads: int = None, dry_run=False
+) -> bool:
+    """run a planned conversion, `threads` is passed to ffmpeg by `set_head`,
+    return False if ffmpeg failed"""
+    ff = FFmpegRunnerAlpha(overwrite=True, banner=False)
+    if threads:
+        ff.set_head(threads=threads, overwrite=True)
+    ff.logger.setLevel(_verbose_log_level(job.verbose))
+    logger = ez_get_logger(f"{__name__}.smartconv", fmt=LOG_FMT_MESSAGE_ONLY)
+    filepath = job.filepath
+    output_path = job.output_path
+    ffmpeg_input_args = FFmpegArgsList(job.input_args)
+    ffmpeg_output_args = FFmpegArgsList(job.output_args)
+    keywords = job.keywords
 
     try:
         try:
@@ -849,10 +1513,10 @@ def kw_video_convert(
                 output_path,
                 ffmpeg_output_args,
                 input_args=ffmpeg_input_args,
-                start=start,
-                end=end,
+                start=job.start,
+                end=job.end,
                 dry_run=dry_run,
-                **kwargs,
+                **job.kwargs,
             )
         except ff.FFmpegError as e:
             if (
@@ -864,29 +1528,133 @@ def kw_video_convert(
                 ffmpeg_input_args.remove("-hwaccel_output_format")
                 ffmpeg_input_args.remove("cuda")
                 _i = ffmpeg_output_args.index("-filter:V:0")
-                ffmpeg_output_args[_i + 1] = new_vf.replace("scale_cuda=", "scale=")
+                ffmpeg_output_args[_i + 1] = ffmpeg_output_args[_i + 1].replace(
+                    "scale_cuda=", "scale="
+                )
 
             ff.convert(
                 [filepath],
                 output_path,
                 ffmpeg_output_args,
                 input_args=ffmpeg_input_args,
-                start=start,
-                end=end,
+                start=job.start,
+                end=job.end,
                 dry_run=dry_run,
-                **kwargs,
+                **job.kwargs,
             )
         logger.info(f"+ {output_path}")
-        shutil.move(filepath, origin_path)
+        if job.origin_path:
+            shutil.move(filepath, job.origin_path)
+        return True
     except ff.FFmpegError as e:
         logger.error(f"! {output_path}\n {e}")
         os.remove(output_path)
+        return False
     except KeyboardInterrupt:
         logger.warning(f"- {output_path}")
         os.remove(output_path)
         sys.exit(2)
 
 
+def kw_video_convert(
+    filepath,
+    keywords=(),
+    vf=None,
+    cut_points=(),
+    overwrite=False,
+    redo=False,
+    ffmpeg_opts=(),
+    verbose=0,
+    dry_run=False,
+    force=False,
+    **kwargs,
+):
+    job = plan_kw_video_convert(
+        filepath,
+        keywords,
+        vf,
+        cut_points,
+        overwrite,
+        redo,
+        ffmpeg_opts,
+        verbose,
+        force,
+        **kwargs,
+    )
+    if job:
+        run_kw_video_convert_job(job, dry_run=dry_run)
+
+
+class KwVideoConvertQueue:
+    """plan `kw_video_convert` of many files up front, then run them concurrently,
+    with a separate number of slots for each encoder class
+
+    software encoders share the cpu `threads` budget evenly, hardware encoders
+    (qsv, nvenc) and stream copies barely load the cpu, so they run in their own
+    slots alongside."""
+
+    default_slots = {
+        ENCODER_SOFTWARE: 1,
+        ENCODER_QSV: 1,
+        ENCODER_NVENC: 1,
+        ENCODER_COPY: 1,
+    }
+
+    def __init__(self, slots: dict = None, threads: int = None, dry_run=False):
+        self.logger = ez_get_logger(f"{__name__}.{self.__class__.__name__}")
+        self.slots = {
+            **self.default_slots,
+            **{k: v for k, v in (slots or {}).items() if v},
+        }
+        self.threads = threads
+        self.dry_run = dry_run
+        self.jobs: typing.List[KwVideoConvertJob] = []
+
+    def add(self, filepath, keywords=(), **kwargs) -> KwVideoConvertJob | None:
+        job = plan_kw_video_convert(filepath, keywords, **kwargs)
+        if job:
+            self.jobs.append(job)
+        return job
+
+    def threads_per_job(self, encoder: str) -> int | None:
+        if encoder != ENCODER_SOFTWARE or not self.threads:
+            return None
+        return max(1, self.threads // self.slots[ENCODER_SOFTWARE])
+
+    def run(self) -> dict:
+        """run all planned jobs, biggest files first,
+        return the count of succeeded & failed jobs"""
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        executors = {
+            encoder: ThreadPoolExecutor(n, thread_name_prefix=encoder)
+            for encoder, n in self.slots.items()
+        }
+        futures = {}
+        counts = {"ok": 0, "failed": 0}
+        jobs, self.jobs = self.jobs, []
+        try:
+            for job in sorted(jobs, key=lambda j: j.size, reverse=True):
+                f = executors[job.encoder].submit(
+                    run_kw_video_convert_job,
+                    job,
+                    threads=self.threads_per_job(job.encoder),
+                    dry_run=self.dry_run,
+                )
+                futures[f] = job
+            wait(futures)
+            for f, job in futures.items():
+                try:
+                    counts["ok" if f.result() else "failed"] += 1
+                except Exception:
+                    self.logger.error(f"! {job.filepath}")
+                    raise
+            return counts
+        finally:
+            for e in executors.values():
+                e.shutdown(wait=True, cancel_futures=True)
+
+
 def parse_kw_opt_str(kw: str):
     if kw[:3] == "crf" and kw[3:].isdecimal():
         return FFmpegArgsList(crf=float(kw[3:]))
@@ -939,6 +1707,8 @@ class FFmpegSegmentsContainer:
     output_prefix = "o-"
     output_json = "o.json"
     output_data = None
+    segment_target_duration = 10.0
+    segment_size_weight = 0.5
 
     class PathError(Exception):
         pass
@@ -1076,22 +1846,32 @@ class FFmpegSegmentsContainer:
         if not i_file:
             raise self.ContainerError("no input filepath")
         d = self.input_data or {S_SEGMENT: {}, S_NON_SEGMENT: {}}
+        d[S_PLAN] = {}
+        r = probe(i_file)
 
         with oldezpykit.stdlib.os.common.ctx_pushd(self.root):
-            for stream in ffmpeg.probe(i_file, select_streams=select_streams)[
-                "streams"
-            ]:
-                index = stream["index"]
+            for stream in r.select_streams(select_streams):
+                index = stream.index
                 # codec = stream['codec_name']
                 # suitable_filext = CODEC_NAME_TO_FILEXT_TABLE.get(codec)
                 # segment_output = '%d' + suitable_filext if suitable_filext else None
                 segment_output = "%d.mkv"
                 index = str(index)
                 d[S_SEGMENT][index] = {}
+                plan = d[S_PLAN][index] = self.plan_segments(i_file, index, r)
+                segment_kwargs = {}
+                if plan["cuts"]:
+                    segment_kwargs["segment_times"] = ",".join(map(str, plan["cuts"]))
+                    segment_kwargs["segment_time_delta"] = 0.05
                 seg_folder = self.input_prefix + index
                 os.makedirs(seg_folder, exist_ok=True)
                 with oldezpykit.stdlib.os.common.ctx_pushd(seg_folder):
-                    self.ff.segment(i_file, segment_output, map="0:{}".format(index))
+                    self.ff.segment(
+                        i_file,
+                        segment_output,
+                        map="0:{}".format(index),
+                        **segment_kwargs,
+                    )
             try:
                 self.ff.convert(
                     [i_file],
@@ -1118,6 +1898,46 @@ class FFmpegSegmentsContainer:
         self.write_metadata()
         self.write_input_json()
 
+    def plan_segments(self, i_file: str, index: str, r: ProbeResult = None) -> dict:
+        """cut points at keyframes
+        balancing segment duration & byte size toward `segment_target_duration`,
+        encoders put keyframes on scene cuts, so do the segments.
+        no cuts (the segment muxer's own splitting) if keyframes cannot be scanned"""
+        r = r or probe(i_file)
+        plan = {
+            "target_duration": self.segment_target_duration,
+            "size_weight": self.segment_size_weight,
+            "cuts": [],
+        }
+        try:
+            scan = probe_cache.keyframes(i_file, index)
+            start_time = r.format.start_time or 0
+            end_time = start_time + r.format.duration
+        except (ffmpeg.Error, TypeError) as e:
+            self.logger.warning(f"no keyframes scanned for stream {index}: {e}")
+            return plan
+        keyframes = scan.keyframes
+        cuts = plan_balanced_cuts(
+            keyframes,
+            end_time,
+            scan.size,
+            self.segment_target_duration,
+            self.segment_size_weight,
+        )
+        bounds = [0, *cuts, len(keyframes)]
+        ends = [*keyframes[1:], (end_time, scan.size)]
+        plan["keyframes"] = len(keyframes)
+        # segment muxer timestamps start from 0, not from the input start time
+        plan["cuts"] = [round(keyframes[i][0] - start_time, 6) for i in cuts]
+        plan["durations"] = [
+            round(ends[b - 1][0] - keyframes[a][0], 3)
+            for a, b in zip(bounds, bounds[1:])
+        ]
+        plan["sizes"] = [
+            ends[b - 1][1] - keyframes[a][1] for a, b in zip(bounds, bounds[1:])
+        ]
+        return plan
+
     def write_metadata(self):
         with oldezpykit.stdlib.os.common.ctx_pushd(self.root):
             self.ff.metadata_file(self.input_filepath, self.metadata_file)
@@ -1158,7 +1978,7 @@ class FFmpegSegmentsContainer:
             for k in d[S_NON_SEGMENT]:
                 file = prefix + k
                 if os.path.isfile(file):
-                    d[S_NON_SEGMENT][k] = ffmpeg.probe(file)
+                    d[S_NON_SEGMENT][k] = probe(file).raw
                 else:
                     del d[S_NON_SEGMENT][k]
             fstk.write_json_file(self.input_json, d, indent=4)
@@ -1464,7 +2284,13 @@ class FFmpegSegmentsContainer:
                     )
         return segments
 
-    def convert(self, overwrite: bool = False):
+    @staticmethod
+    def default_workers() -> int:
+        """each ffmpeg encoder is already multi-threaded,
+        so only run about one per 4 logical cores"""
+        return max(1, (os.cpu_count() or 1) // 4)
+
+    def convert(self, overwrite: bool = False, workers: int = None):
         if overwrite:
 
             def get_segments():
@@ -1476,10 +2302,60 @@ class FFmpegSegmentsContainer:
                 return self.list_untouched_segments()
 
         segments = get_segments()
+        workers = workers or self.default_workers()
+        if workers > 1 and len(segments) > 1:
+            return self.convert_in_pool(segments, workers, overwrite=overwrite)
         while segments:
             # stream_id, segment_file = random.choice(segments)
             stream_id, segment_file = segments.pop(0)
-            self.convert_one_segment(stream_id, segment_file, overwrite=overwrite)
+            with self.skip_taken_segment(stream_id, segment_file):
+                self.convert_one_segment(stream_id, segment_file, overwrite=overwrite)
+
+    @contextlib.contextmanager
+    def skip_taken_segment(self, stream_id, segment_file):
+        """segments locked by, or deleted on request of, another run are skipped"""
+        try:
+            yield
+        except self.SegmentLockedError:
+            self.logger.info(f"skip locked segment {stream_id}/{segment_file}")
+        except self.SegmentDeleteRequest:
+            self.logger.info(f"deleted segment {stream_id}/{segment_file}")
+
+    def convert_in_pool(self, segments: list, workers: int, overwrite: bool = False):
+        """encode segments concurrently in a process pool
+
+        the container is sent once to each worker process (by the pool initializer),
+        tasks only carry the segment names.
+        the pool queue hands each segment to exactly one worker, so the random naps
+        are skipped, while the .LOCK/.DONE marker files are still written for resumed
+        or multi-host runs"""
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        self.logger.info(f"convert {len(segments)} segments with {workers} workers")
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_segment_worker,
+            initargs=(self,),
+        )
+        try:
+            futures = {
+                executor.submit(
+                    _convert_one_segment_in_worker,
+                    stream_id,
+                    segment_file,
+                    overwrite,
+                ): (stream_id, segment_file)
+                for stream_id, segment_file in segments
+            }
+            for fu in as_completed(futures):
+                stream_id, segment_file = futures[fu]
+                with self.skip_taken_segment(stream_id, segment_file):
+                    fu.result()
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        else:
+            executor.shutdown(wait=True)
 
     def nap(self):
         t = round(random.uniform(0.2, 0.4), 3)
@@ -1510,35 +2386,40 @@ class FFmpegSegmentsContainer:
     def file_tag_delete(self, filepath):
         oldezpykit.stdlib.os.common.touch(filepath + self.suffix_delete)
 
-    def convert_one_segment(self, stream_id, segment_file, overwrite=False) -> dict:
+    def convert_one_segment(
+        self, stream_id, segment_file, overwrite=False, nap=True
+    ) -> dict:
+        # absolute paths instead of changing cwd,
+        # so segments can be converted from several threads
         segment_path_no_prefix = os.path.join(stream_id, segment_file)
-        i_seg = self.input_prefix + segment_path_no_prefix
-        o_seg = self.output_prefix + segment_path_no_prefix
+        i_seg = os.path.join(self.root, self.input_prefix + segment_path_no_prefix)
+        o_seg = os.path.join(self.root, self.output_prefix + segment_path_no_prefix)
         args = self.output_data[S_SEGMENT]
-        with oldezpykit.stdlib.os.common.ctx_pushd(self.root):
+        if nap:
             self.nap()
-            if self.file_has_lock(o_seg):
-                raise self.SegmentLockedError
-            if not overwrite and self.file_has_done(o_seg):
-                return self.get_done_segment_info(filepath=o_seg)
-            self.file_tag_lock(o_seg)
-            try:
-                saved_error = None
-                self.ff.convert([i_seg], o_seg, args)
+        if self.file_has_lock(o_seg):
+            raise self.SegmentLockedError
+        if not overwrite and self.file_has_done(o_seg):
+            return self.get_done_segment_info(filepath=o_seg)
+        self.file_tag_lock(o_seg)
+        try:
+            saved_error = None
+            self.ff.convert([i_seg], o_seg, args)
+            if nap:
                 self.nap()
-                if self.file_has_delete(o_seg):
-                    self.logger.info("delete {}".format(o_seg))
-                    os.remove(o_seg)
-                    raise self.SegmentDeleteRequest
-                else:
-                    self.file_tag_done(o_seg)
-                    return self.get_done_segment_info(filepath=o_seg)
-            except Exception as e:
-                saved_error = e
-            finally:
-                self.file_tag_unlock(o_seg)
-                if saved_error:
-                    raise saved_error
+            if self.file_has_delete(o_seg):
+                self.logger.info("delete {}".format(o_seg))
+                os.remove(o_seg)
+                raise self.SegmentDeleteRequest
+            else:
+                self.file_tag_done(o_seg)
+                return self.get_done_segment_info(filepath=o_seg)
+        except Exception as e:
+            saved_error = e
+        finally:
+            self.file_tag_unlock(o_seg)
+            if saved_error:
+                raise saved_error
 
     def get_done_segment_info(
         self, stream_id=None, segment_filename=None, filepath=None
@@ -1547,10 +2428,10 @@ class FFmpegSegmentsContainer:
             o_seg = filepath
         else:
             o_seg = os.path.join(self.output_prefix + stream_id, segment_filename)
-        with oldezpykit.stdlib.os.common.ctx_pushd(self.root):
-            if not self.file_has_done(o_seg):
-                raise self.SegmentNotDoneError
-            return excerpt_single_video_stream(o_seg)
+        o_seg = os.path.join(self.root, o_seg)
+        if not self.file_has_done(o_seg):
+            raise self.SegmentNotDoneError
+        return excerpt_single_video_stream(o_seg)
 
     def estimate(self, overwrite=True) -> dict:
         d = {}
@@ -1683,3 +2564,17 @@ class FFmpegSegmentsContainer:
         e = self.estimate()
         r = e[i]
         return round(crf0 + 6 * log(r, 2), 1)
+
+
+_worker_container: FFmpegSegmentsContainer = None
+
+
+def _init_segment_worker(container: FFmpegSegmentsContainer):
+    global _worker_container
+    _worker_container = container
+
+
+def _convert_one_segment_in_worker(stream_id, segment_file, overwrite=False):
+    return _worker_container.convert_one_segment(
+        stream_id, segment_file, overwrite=overwrite, nap=False
+    )
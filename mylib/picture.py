@@ -2,19 +2,19 @@
 # encoding=utf8
 import copy
 import json
-from itertools import combinations
 from logging import warning
 from typing import Iterable
 
+import numpy as np
 from PIL import Image
 from disjoint_set import DisjointSet
-from imagehash import average_hash, dhash, phash, whash, hex_to_hash
+from imagehash import ImageHash, average_hash, dhash, phash, whash, hex_to_hash
 
 import oldezpykit.stdlib.os.common
 from mylib.easy import *
 from mylib.ext import fstk
 from mylib.ext.ostk import check_file_ext
-from mylib.ext.tricks import percentage
+from mylib.ext.tricks import percentage, SimpleSQLiteTable
 
 Image.MAX_IMAGE_PIXELS = 268435456
 
@@ -34,6 +34,7 @@ IMAGE_FILE_EXT_ANIMATION = ['.gif', '.apng']
 DEFAULT_IMAGE_HASHTYPE = DHASH
 DEFAULT_IMAGE_HASHSIZE = 8
 IMAGEHASH_FILENAME = 'imagehash.json'
+IMAGEHASH_CACHE_FILENAME = 'imagehash.sqlite3'
 SIMILAR_IMAGE_FOLDER = '__similar__'
 
 
@@ -55,6 +56,17 @@ def open_image_file(path: str) -> Image.Image:
     return Image.open(path)
 
 
+def open_image_file_reduced(image_path: str, hashsize: int = DEFAULT_IMAGE_HASHSIZE) -> Image.Image:
+    """open an image reduced to what the hash functions need,
+    `thumbnail` drafts JPEG (reduced DCT decode), so big JPEGs are never decoded in full"""
+    im = open_image_file(image_path)
+    short, long = sorted(im.size)
+    in_cut = hashsize * 2
+    out_cut = in_cut * long / short
+    im.thumbnail((out_cut, out_cut))
+    return im
+
+
 def hash_image_file(
         image_path: str,
         hashtype: str = DEFAULT_IMAGE_HASHTYPE,
@@ -69,11 +81,7 @@ def hash_image_file(
             return hash_db[f'{hashtype}-{hashsize}x{hashsize}'][image_path]
         except KeyError:
             pass
-    im = open_image_file(image_path)
-    short, long = sorted(im.size)
-    in_cut = hashsize * 2
-    out_cut = in_cut * long / short
-    im.thumbnail((out_cut, out_cut))
+    im = open_image_file_reduced(image_path, hashsize)
     variants_l = [im]
     if trans:
         for t in (Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270, Image.FLIP_LEFT_RIGHT, Image.FLIP_TOP_BOTTOM):
@@ -90,6 +98,23 @@ def hash_image_file(
     return hash_l
 
 
+def benchmark_hash_image_files(image_paths: Iterable, hashsize: int = DEFAULT_IMAGE_HASHSIZE, **kwargs) -> dict:
+    """throughput of `hash_image_file` over a sample corpus, and the part of it spent decoding"""
+    image_paths = list(image_paths)
+    r = {'files': len(image_paths)}
+    t0 = time.perf_counter()
+    for p in image_paths:
+        open_image_file_reduced(p, hashsize)
+    r['decode_seconds'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for p in image_paths:
+        hash_image_file(p, hashsize=hashsize, **kwargs)
+    t = r['seconds'] = time.perf_counter() - t0
+    r['files_per_second'] = len(image_paths) / t if t else 0
+    r['decode_share'] = r['decode_seconds'] / t if t else 0
+    return r
+
+
 def write_imagehash_file(hash_db: dict = None, path: str = IMAGEHASH_FILENAME):
     d = copy.deepcopy(hash_db) if hash_db else dict()
     with open(path, 'w') as fp:
@@ -114,28 +139,128 @@ def read_imagehash_file(path: str = IMAGEHASH_FILENAME):
         return dict()
 
 
+def image_hash_list_to_bytes(hash_list: list) -> bytes:
+    return b''.join(np.packbits(np.asarray(h.hash, dtype=bool).flatten()).tobytes() for h in hash_list)
+
+
+def image_hash_list_from_bytes(data: bytes, hashsize: int) -> list:
+    bits = hashsize * hashsize
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, (bits + 7) // 8)
+    return [ImageHash(np.unpackbits(row)[:bits].reshape(hashsize, hashsize).astype(bool)) for row in packed]
+
+
+class ImageHashCache:
+    """persistent sqlite cache of image hashes, one table per hash type & size
+
+    an entry is valid only while the file keeps the same size and mtime,
+    entries of files no longer listed are pruned without decoding anything"""
+
+    def __init__(self, db_path: str = IMAGEHASH_CACHE_FILENAME):
+        self.db_path = db_path
+        self.tables = {}
+
+    def table(self, hashtype: str, hashsize: int) -> SimpleSQLiteTable:
+        name = f'{hashtype}_{hashsize}x{hashsize}'
+        if name not in self.tables:
+            self.tables[name] = SimpleSQLiteTable(
+                self.db_path, name,
+                ['path text primary key', 'size integer', 'mtime integer', 'trans integer', 'hashes blob'])
+        return self.tables[name]
+
+    def load(self, hashtype: str, hashsize: int) -> dict:
+        """{path: (size, mtime, trans, hashes_bytes)}"""
+        return {r[0]: r[1:] for r in self.table(hashtype, hashsize).select()}
+
+    def put(self, hashtype: str, hashsize: int, path: str, stat: os.stat_result, trans: bool, hash_list: list):
+        self.table(hashtype, hashsize).insert(
+            (path, stat.st_size, stat.st_mtime_ns, int(trans), image_hash_list_to_bytes(hash_list)))
+
+    def prune(self, hashtype: str, hashsize: int, stale_paths: Iterable):
+        t = self.table(hashtype, hashsize)
+        t.cursor.executemany(f'delete from {t.table_name} where path = ?', [(p,) for p in stale_paths])
+
+    def commit(self):
+        for t in self.tables.values():
+            t.connection.commit()
+
+    def close(self):
+        self.commit()
+        for t in self.tables.values():
+            t.close()
+        self.tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _hash_image_file_in_worker(image_path: str, kwargs: dict):
+    try:
+        return hash_image_file(image_path, **kwargs)
+    except (OSError, ValueError) as e:
+        warning(f'{image_path}: {e!r}')
+        return []
+
+
 def hash_all_image_files(
         hash_db: dict = None,
         hashtype: str = DEFAULT_IMAGE_HASHTYPE,
         hashsize: int = DEFAULT_IMAGE_HASHSIZE,
         trans: bool = True,
         stat: bool = True,
+        cache: ImageHashCache = None,
+        workers: int = None,
+        commit_every: int = 256,
         **kwargs
 ):
+    """hash images in current dir, those missing from `hash_db` and from `cache` are hashed in a process pool
+
+    `workers=1` hashes in the current process"""
     key = f'{hashtype}-{hashsize}x{hashsize}'
     db = hash_db or {key: {}}
-    dk = db[key]
+    dk = db.setdefault(key, {})
     images_l = list_all_image_files()
-    effect_cnt, round_cnt = 0, 0
+    stat_d = {f: os.stat(f) for f in images_l}
+    if cache:
+        cached = cache.load(hashtype, hashsize)
+        cache.prune(hashtype, hashsize, set(cached) - set(images_l))
+        for f, (size, mtime, cached_trans, data) in cached.items():
+            st = stat_d.get(f)
+            if f not in dk and st and st.st_size == size and st.st_mtime_ns == mtime and bool(cached_trans) == trans:
+                dk[f] = image_hash_list_from_bytes(data, hashsize)
+    todo_l = [f for f in images_l if f not in dk]
+    effect_cnt, round_cnt = 0, len(images_l) - len(todo_l)
     total_cnt = len(images_l)
-    for f in images_l:
-        if f not in dk:
-            dk[f] = hash_image_file(f, hashtype=hashtype, hashsize=hashsize, trans=trans, **kwargs)
-            if stat:
-                effect_cnt += 1
-        if stat:
+    hash_kwargs = dict(hashtype=hashtype, hashsize=hashsize, trans=trans, **kwargs)
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(todo_l) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(
+            _hash_image_file_in_worker, todo_l, itertools.repeat(hash_kwargs),
+            chunksize=max(1, min(64, len(todo_l) // (workers * 4))))
+    else:
+        executor = None
+        results = (_hash_image_file_in_worker(f, hash_kwargs) for f in todo_l)
+    try:
+        for f, hash_l in zip(todo_l, results):
             round_cnt += 1
-            print('hash:', percentage(round_cnt / total_cnt), total_cnt, round_cnt, effect_cnt, end='\r')
+            if hash_l:
+                dk[f] = hash_l
+                effect_cnt += 1
+                if cache:
+                    cache.put(hashtype, hashsize, f, stat_d[f], trans, hash_l)
+                    if effect_cnt % commit_every == 0:
+                        cache.commit()
+            if stat:
+                print('hash:', percentage(round_cnt / total_cnt), total_cnt, round_cnt, effect_cnt, end='\r')
+    finally:
+        if cache:
+            cache.commit()
+        if executor:
+            executor.shutdown(cancel_futures=True)
     if stat:
         print()
     return db
@@ -146,7 +271,161 @@ def diff_image_hash_list(hash_list1: list, hash_list2: list):
     return diff
 
 
+def image_hash_to_int(h) -> int:
+    """pack an `ImageHash` into a plain int, so hamming distance is `(a ^ b).bit_count()`"""
+    return int(str(h), 16)
+
+
+class HammingBKTree:
+    """BK-tree over int-packed hashes, answers "all items within hamming distance d" without a pairwise scan
+
+    it only prunes well for small `d`, at larger ones (e.g. 12 of 64 bits) nearly every node is visited
+    and the numpy block scan of `pair_similar_images` is much faster, see `BK_TREE_MAX_DISTANCE`
+
+    node layout is `[hash, items, children]`, `children` maps distance to child node"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, h: int, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = (h ^ node[0]).bit_count()
+            if d == 0:
+                node[1].append(item)
+                return
+            children = node[2]
+            if d in children:
+                node = children[d]
+            else:
+                children[d] = [h, [item], {}]
+                return
+
+    def find(self, h: int, max_dist: int):
+        """yield `(item, distance)` for every item within `max_dist`"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node_h, items, children = stack.pop()
+            d = (h ^ node_h).bit_count()
+            if d <= max_dist:
+                for item in items:
+                    yield item, d
+            lo, hi = d - max_dist, d + max_dist
+            for child_d, child in children.items():
+                if lo <= child_d <= hi:
+                    stack.append(child)
+
+
+BK_TREE_MAX_DISTANCE = 2  # beyond this hamming distance the block scan beats the BK-tree
+_POPCOUNT_U8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_image_hash_lists(hash_lists: Iterable) -> np.ndarray:
+    """pack lists of `ImageHash` variants into a uint8 array of shape (images, variants, bytes)
+
+    lists shorter than the longest one are padded with their first hash, which does not change any minimum"""
+    hash_lists = [list(hl) for hl in hash_lists]
+    if not hash_lists:
+        return np.zeros((0, 1, 1), dtype=np.uint8)
+    n_variants = max(len(hl) for hl in hash_lists)
+    rows = []
+    for hl in hash_lists:
+        packed = [np.packbits(np.asarray(h.hash, dtype=bool).flatten()) for h in hl]
+        packed += [packed[0]] * (n_variants - len(packed))
+        rows.append(packed)
+    return np.array(rows, dtype=np.uint8)
+
+
+def _popcount_sum(x: np.ndarray) -> np.ndarray:
+    """bit count summed over the last (bytes) axis"""
+    if hasattr(np, 'bitwise_count') and x.shape[-1] % 8 == 0:
+        return np.bitwise_count(np.ascontiguousarray(x).view(np.uint64)).sum(axis=-1, dtype=np.int32)
+    return _POPCOUNT_U8[x].sum(axis=-1, dtype=np.int32)
+
+
+def hamming_distance_block(packed_a: np.ndarray, packed_b: np.ndarray) -> np.ndarray:
+    """min hamming distance over all variant pairs, for every image in `packed_a` against every image in `packed_b`"""
+    x = packed_a[:, None, :, None, :] ^ packed_b[None, :, None, :, :]
+    return _popcount_sum(x).min(axis=(2, 3))
+
+
+def iter_hamming_distance_blocks(
+        packed_a: np.ndarray,
+        packed_b: np.ndarray = None,
+        block_size: int = 256,
+):
+    """yield `(row_offset, col_offset, distance_matrix_block)`
+
+    if `packed_b` is omitted, `packed_a` is compared with itself and only blocks on or above the diagonal are yielded"""
+    triangle = packed_b is None
+    if triangle:
+        packed_b = packed_a
+    for i in range(0, len(packed_a), block_size):
+        for j in range(i if triangle else 0, len(packed_b), block_size):
+            yield i, j, hamming_distance_block(packed_a[i:i + block_size], packed_b[j:j + block_size])
+
+
+def hamming_distance_matrix(hash_lists_a: Iterable, hash_lists_b: Iterable = None, block_size: int = 256) -> np.ndarray:
+    """batch API: full matrix of min hamming distances between lists of `ImageHash` variants"""
+    packed_a = pack_image_hash_lists(hash_lists_a)
+    packed_b = packed_a if hash_lists_b is None else pack_image_hash_lists(hash_lists_b)
+    m = np.empty((len(packed_a), len(packed_b)), dtype=np.int32)
+    for i, j, block in iter_hamming_distance_blocks(packed_a, packed_b, block_size=block_size):
+        m[i:i + block.shape[0], j:j + block.shape[1]] = block
+    return m
+
+
 def pair_similar_images(
+        hash_db: dict,
+        threshold: float = 0.8,
+        hashtype: str = DEFAULT_IMAGE_HASHTYPE,
+        hashsize: int = DEFAULT_IMAGE_HASHSIZE,
+        stat: bool = True,
+        index: bool = None,
+        block_size: int = 256,
+        **kwargs
+):
+    """return list of lists, the n-th list contains image pairs with hamming distance n
+
+    compute distance matrices of every combination of 2 images block by block,
+    or with `index`, query a BK-tree of all hash variants instead.
+    `index=None` uses the BK-tree only up to `BK_TREE_MAX_DISTANCE`, where it prunes well"""
+    max_diff = ist2hd(threshold, hashsize=hashsize)
+    if index is None:
+        index = max_diff <= BK_TREE_MAX_DISTANCE
+    if index:
+        return pair_similar_images_indexed(hash_db, threshold, hashtype=hashtype, hashsize=hashsize, stat=stat)
+    diff_pairs_ll = [list() for _ in range(max_diff + 1)]
+    dm = hash_db[f'{hashtype}-{hashsize}x{hashsize}']
+    images_l = list(dm)
+    packed = pack_image_hash_lists(dm[img] for img in images_l)
+    effect_cnt, round_cnt = 0, 0
+    total_cnt = max(len(images_l) * (len(images_l) - 1) // 2, 1)
+    for i0, j0, block in iter_hamming_distance_blocks(packed, block_size=block_size):
+        rows, cols = np.nonzero(block <= max_diff)
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            i, j = i0 + r, j0 + c
+            if i < j:
+                diff_pairs_ll[int(block[r, c])].append((images_l[i], images_l[j]))
+                if stat:
+                    effect_cnt += 1
+        if stat:
+            h, w = block.shape
+            round_cnt += h * (h - 1) // 2 if i0 == j0 else h * w
+            print('diff:', percentage(round_cnt / total_cnt), total_cnt, round_cnt, effect_cnt, end='\r')
+    if stat:
+        print()
+    return diff_pairs_ll
+
+
+def pair_similar_images_indexed(
         hash_db: dict,
         threshold: float = 0.8,
         hashtype: str = DEFAULT_IMAGE_HASHTYPE,
@@ -154,21 +433,30 @@ def pair_similar_images(
         stat: bool = True,
         **kwargs
 ):
+    """same result as `pair_similar_images(..., index=False)`, pairs keep the order of `hash_db`
+
+    each image is queried against the tree holding the images before it, then added to the tree,
+    so every pair is found exactly once. the cost grows sub-quadratically only for very low distances,
+    at larger ones this is much slower than the block scan"""
     max_diff = ist2hd(threshold, hashsize=hashsize)
-    diff_pairs_ll = []
+    diff_pairs_ll = [list() for _ in range(max_diff + 1)]
     dm = hash_db[f'{hashtype}-{hashsize}x{hashsize}']
-    for _ in range(max_diff + 1):
-        diff_pairs_ll += [list()]
-    image_pairs_l = [c for c in combinations(dm, 2)]
+    tree = HammingBKTree()
     effect_cnt, round_cnt = 0, 0
-    total_cnt = len(image_pairs_l)
-    for img1, img2 in image_pairs_l:
-        diff = diff_image_hash_list(dm[img1], dm[img2])
-        if diff <= max_diff:
-            diff_pairs_ll[diff].append((img1, img2))
-            if stat:
-                effect_cnt += 1
+    total_cnt = len(dm)
+    for img in dm:
+        int_hash_l = [image_hash_to_int(h) for h in dm[img]]
+        nearest = {}
+        for h in int_hash_l:
+            for other, diff in tree.find(h, max_diff):
+                if diff < nearest.get(other, max_diff + 1):
+                    nearest[other] = diff
+        for other, diff in nearest.items():
+            diff_pairs_ll[diff].append((other, img))
+        for h in int_hash_l:
+            tree.add(h, img)
         if stat:
+            effect_cnt += len(nearest)
             round_cnt += 1
             print('diff:', percentage(round_cnt / total_cnt), total_cnt, round_cnt, effect_cnt, end='\r')
     if stat:
@@ -176,6 +464,18 @@ def pair_similar_images(
     return diff_pairs_ll
 
 
+def benchmark_pair_similar_images(hash_db: dict, threshold: float = 0.8, **kwargs) -> dict:
+    """time the pairwise scan against the BK-tree index on the same hash db, and check the results are equal"""
+    r = {}
+    results = {}
+    for index in (False, True):
+        t0 = time.perf_counter()
+        results[index] = pair_similar_images(hash_db, threshold, stat=False, index=index, **kwargs)
+        r['index' if index else 'pairwise'] = time.perf_counter() - t0
+    r['equal'] = [set(pairs) for pairs in results[False]] == [set(pairs) for pairs in results[True]]
+    return r
+
+
 def group_similar_images(
         similar_pairs_ll: list,
         groups_ds: DisjointSet = None,
@@ -234,6 +534,7 @@ def view_similar_images_auto(
         trans: bool = True,
         stat: bool = True,
         dryrun: bool = False,
+        index: bool = None,
         **kwargs
 ):
     thresholds = thresholds or [1, 0.95, 0.9, 0.85]
@@ -241,9 +542,9 @@ def view_similar_images_auto(
     hashtype = hashtype or DEFAULT_IMAGE_HASHTYPE
     hashsize = hashsize or DEFAULT_IMAGE_HASHSIZE
     common_kwargs = {'hashtype': hashtype, 'hashsize': hashsize, 'trans': trans, 'stat': stat}
-    db = hash_all_image_files(hash_db=read_imagehash_file(), **common_kwargs)
-    write_imagehash_file(db)
-    similar_pairs_ll = pair_similar_images(db, min(thresholds), **common_kwargs)
+    with ImageHashCache() as cache:
+        db = hash_all_image_files(cache=cache, **common_kwargs)
+    similar_pairs_ll = pair_similar_images(db, min(thresholds), index=index, **common_kwargs)
     hd_l = [ist2hd(th, hashsize=hashsize) for th in thresholds]
     hd_l.sort()
     last_hd = 0
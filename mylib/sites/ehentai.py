@@ -3,15 +3,13 @@ import json
 import zipfile
 from collections import defaultdict
 
-import requests
-
 import oldezpykit.stdlib.os.common
 from mylib.__deprecated__ import get_re_groups
 from mylib.easy import *
-from mylib.easy import logging
+from mylib.easy import asyncio, logging
 from mylib.ext import fstk
 from mylib.ext.tricks import is_hex
-from mylib.web_client import cookies_dict_from_netscape_file, get_html_element_tree
+from mylib.web_client import cookies_dict_from_netscape_file, get_html_element_tree, get_session, get_rate_limiter
 from oldezpykit.metautil import VoidDuck
 from websites.ehentai import EHentaiError
 
@@ -64,22 +62,118 @@ def guess_creators_from_ehentai_title(x: str):
 
 
 def ehviewer_images_catalog(root_dir, *, dry_run: bool = False, db_json_path: str = 'ehdb.json'):
+    """move EHViewer downloaded images into folders by creator and title
+
+    missing gallery data is fetched concurrently under the API rate limit,
+    each gallery is appended to a journal beside the DB file as soon as it arrives and its files are moved at once,
+    so an interrupted run loses nothing already fetched"""
     logger = logging.ez_get_logger('ehvimg', fmt=logging.LOG_FMT_MESSAGE_ONLY)
     logmsg_move = '* move {} -> {}'
     logmsg_skip = '# skip {}'
     logmsg_data = '+ /g/{}/{}'
     logmsg_err = '! {}'
 
+    db_json_path = os.path.abspath(db_json_path)
+    journal_path = db_json_path + '.journal'
     if os.path.isfile(db_json_path):
         logger.info('@ using DB file: {}'.format(db_json_path))
         db = fstk.read_json_file(db_json_path)
         db = {int(k): v for k, v in db.items()}
     else:
         db = {}
+    if os.path.isfile(journal_path):
+        logger.info('@ using DB journal: {}'.format(journal_path))
+        with open(journal_path, encoding='utf8') as jf:
+            for line in jf:
+                try:
+                    d = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                db[int(d['gid'])] = d
+
+    def catalog_file(f):
+        g = EHentaiGallery(f, logger=logger)
+        d = db[g.gid]
+        creators = []
+        title = d['title'].strip()
+        try:
+            core_title = find_core_title(title) or '__INVALID_CORE_TITLE__'
+            core_title_l = re.findall(r'[\w]+[\-+\']?[\w]?', core_title)
+            if title[:1] + title[-1:] == '[]':
+                creators.append(title[1:-1].strip())
+        except AttributeError:
+            print(logmsg_err.format(title))
+            raise
+        comic_magazine_title = None
+        if core_title_l and core_title_l[0].lower() == 'comic':
+            comic_magazine_title_l = []
+            for s in core_title_l[1:]:
+                if re.match(r'^\d+', s):
+                    break
+                elif re.match(r'^(?:vol|no\.|#)(.*)$', s.lower()):
+                    break
+                else:
+                    comic_magazine_title_l.append(s)
+            if comic_magazine_title_l:
+                comic_magazine_title = 'COMIC ' + ' '.join(comic_magazine_title_l)
+
+        tags = d['tags']
+
+        if 'artist' in tags:
+            creators = tags['artist']
+        elif 'group' in tags:
+            creators = tags['group']
+        elif 'cosplayer' in tags:
+            creators = tags['cosplayer']
+        else:
+            creators = guess_creators_from_ehentai_title(title)
+            if creators:
+                core_title = title
+            # todo: clean below code block if guess_creators_from_ehentai_title work well
+            # for m in (
+            #         re.match(r'^(?:\([^)]+\))\s*\[([^]]+)]', title),
+            #         re.match(r'^\[(?:pixiv|fanbox|tumblr|twitter)]\s*(.+)\s*[(\[]', title, flags=re.I),
+            #         re.match(r'^\W*artist\W*(\w.*)', title, flags=re.I),
+            # ):
+            #     if m:
+            #         m1 = m.group(1).strip()
+            #         if m1:
+            #             if '|' in m1:
+            #                 creators = [e.strip() for e in m1.split('|')]
+            #             else:
+            #                 creators = [m1]
+            #             core_title = title
+            #         break
+        if comic_magazine_title:
+            folder = comic_magazine_title.replace('COMIC X-E ROS', 'COMIC X-EROS')
+        elif 'anthology' in tags.get('misc', []):
+            folder = '(anthology)'
+        elif creators:
+            if len(creators) > 3:
+                folder = VARIOUS
+            else:
+                folder = ', '.join(creators)
+        else:
+            folder = UNKNOWN
+        # print(f': {title}')  # DEBUG
+        # print(f': {core_title}')  # DEBUG
+
+        sub_folder = fstk.make_path(
+            fstk.sanitize_xu200(folder),
+            f'{fstk.sanitize_xu200(title)} {g.gid}-{g.token} ehvimg'  # use title instead of core title
+        )
+        parent, basename = os.path.split(f)
+        no_ext, ext = os.path.splitext(basename)
+        no_ext = fstk.sanitize_xu240(no_ext.split()[-1])
+        new_path = fstk.make_path(sub_folder, no_ext + ext)
+        logger.info(logmsg_move.format(f, new_path))
+        if not dry_run:
+            os.makedirs(sub_folder, exist_ok=True)
+            shutil.move(f, new_path)
 
     with oldezpykit.stdlib.os.common.ctx_pushd(root_dir):
         not_found_gid_token = []
-        files = []
+        files_of_gid = defaultdict(list)
         for f in next(os.walk('.'))[-1]:
             try:
                 g = EHentaiGallery(f, logger=logger)
@@ -89,95 +183,33 @@ def ehviewer_images_catalog(root_dir, *, dry_run: bool = False, db_json_path: st
             if g.gid not in db and (g.gid, g.token) not in not_found_gid_token:
                 not_found_gid_token.append((g.gid, g.token))
                 print(logmsg_data.format(g.gid, g.token))
-            files.append(f)
+            files_of_gid[g.gid].append(f)
+
+        for gid in list(files_of_gid):
+            if gid in db:
+                for f in files_of_gid.pop(gid):
+                    catalog_file(f)
 
         if not_found_gid_token:
             print('... RETRIEVE GALLERY DATA FROM E-HENTAI API ...')
-            print('... IT WILL TAKE A LONG TIME ...')
-            eh_api = EHentaiAPI()
-            for d in eh_api.get_gallery_data(not_found_gid_token):
-                db[d['gid']] = d
-            fstk.write_json_file(db_json_path, db)
 
-        for f in files:
-            g = EHentaiGallery(f, logger=logger)
-            d = db[g.gid]
-            creators = []
-            title = d['title'].strip()
-            try:
-                core_title = find_core_title(title) or '__INVALID_CORE_TITLE__'
-                core_title_l = re.findall(r'[\w]+[\-+\']?[\w]?', core_title)
-                if title[:1] + title[-1:] == '[]':
-                    creators.append(title[1:-1].strip())
-            except AttributeError:
-                print(logmsg_err.format(title))
-                raise
-            comic_magazine_title = None
-            if core_title_l and core_title_l[0].lower() == 'comic':
-                comic_magazine_title_l = []
-                for s in core_title_l[1:]:
-                    if re.match(r'^\d+', s):
-                        break
-                    elif re.match(r'^(?:vol|no\.|#)(.*)$', s.lower()):
-                        break
-                    else:
-                        comic_magazine_title_l.append(s)
-                if comic_magazine_title_l:
-                    comic_magazine_title = 'COMIC ' + ' '.join(comic_magazine_title_l)
-
-            tags = d['tags']
-
-            if 'artist' in tags:
-                creators = tags['artist']
-            elif 'group' in tags:
-                creators = tags['group']
-            elif 'cosplayer' in tags:
-                creators = tags['cosplayer']
-            else:
-                creators = guess_creators_from_ehentai_title(title)
-                if creators:
-                    core_title = title
-                # todo: clean below code block if guess_creators_from_ehentai_title work well
-                # for m in (
-                #         re.match(r'^(?:\([^)]+\))\s*\[([^]]+)]', title),
-                #         re.match(r'^\[(?:pixiv|fanbox|tumblr|twitter)]\s*(.+)\s*[(\[]', title, flags=re.I),
-                #         re.match(r'^\W*artist\W*(\w.*)', title, flags=re.I),
-                # ):
-                #     if m:
-                #         m1 = m.group(1).strip()
-                #         if m1:
-                #             if '|' in m1:
-                #                 creators = [e.strip() for e in m1.split('|')]
-                #             else:
-                #                 creators = [m1]
-                #             core_title = title
-                #         break
-            if comic_magazine_title:
-                folder = comic_magazine_title.replace('COMIC X-E ROS', 'COMIC X-EROS')
-            elif 'anthology' in tags.get('misc', []):
-                folder = '(anthology)'
-            elif creators:
-                if len(creators) > 3:
-                    folder = VARIOUS
-                else:
-                    folder = ', '.join(creators)
-            else:
-                folder = UNKNOWN
-            # print(f': {title}')  # DEBUG
-            # print(f': {core_title}')  # DEBUG
-
-            sub_folder = fstk.make_path(
-                fstk.sanitize_xu200(folder),
-                f'{fstk.sanitize_xu200(title)} {g.gid}-{g.token} ehvimg'  # use title instead of core title
-            )
-            parent, basename = os.path.split(f)
-            no_ext, ext = os.path.splitext(basename)
-            no_ext = fstk.sanitize_xu240(no_ext.split()[-1])
-            new_path = fstk.make_path(sub_folder, no_ext + ext)
-            logger.info(logmsg_move.format(f, new_path))
-            if not dry_run:
-                os.makedirs(sub_folder, exist_ok=True)
-                shutil.move(f, new_path)
+            async def fetch_and_catalog():
+                async for d in EHentaiAPI().iter_gallery_data_async(not_found_gid_token):
+                    if 'error' in d:
+                        logger.info(logmsg_err.format(d))
+                        continue
+                    db[d['gid']] = d
+                    journal.write(json.dumps(d) + '\n')
+                    journal.flush()
+                    for f in files_of_gid.pop(d['gid'], []):
+                        catalog_file(f)
+
+            with open(journal_path, 'a', encoding='utf8') as journal:
+                asyncio.run(fetch_and_catalog())
+
+        if os.path.isfile(journal_path):
+            fstk.write_json_file(db_json_path, db)
+            os.remove(journal_path)
 
 
 class EHentaiGallery:
@@ -250,7 +282,7 @@ class EHentaiGallery:
 
     def gdata(self, wait=None, logger=None):
         j = {'method': 'gdata', 'namespace': 1, 'gidlist': [[self.gid, self.token]]}
-        r = requests.post('https://api.e-hentai.org/api.php', json=j)
+        r = get_session(EHentaiAPI.API_URL).post(EHentaiAPI.API_URL, json=j)
         gdata = r.json()
         if 'error' in gdata:
             raise EHentaiError(gdata['error'])
@@ -408,11 +440,37 @@ class EHentaiAPI:
     API_URL = 'https://api.e-hentai.org/api.php'
     max_entries = 25
     interval = 1
+    burst = 1
+    max_retries = 3
+    concurrency = 4
+
+    def __init__(self):
+        self.rate_limiter = get_rate_limiter(self.API_URL, rate=1 / self.interval, burst=self.burst)
+
+    def _post_once(self, j):
+        r = get_session(self.API_URL).post(self.API_URL, json=j)
+        if r.status_code in (429, 503):
+            self.rate_limiter.penalize()
+            return r, None
+        self.rate_limiter.reward()
+        return r, r.json()
 
     def post(self, j):
-        r = requests.post(self.API_URL, json=j)
-        sleep(self.interval)
-        return r.json()
+        for _ in range(self.max_retries):
+            self.rate_limiter.acquire()
+            r, data = self._post_once(j)
+            if data is not None:
+                return data
+        raise EHentaiError(f'HTTP {r.status_code} {r.reason}')
+
+    async def post_async(self, j):
+        """same as `post`, the blocking request runs in a thread, so many posts can be in flight"""
+        for _ in range(self.max_retries):
+            await self.rate_limiter.acquire_async()
+            r, data = await asyncio.to_thread(self._post_once, j)
+            if data is not None:
+                return data
+        raise EHentaiError(f'HTTP {r.status_code} {r.reason}')
 
     def split_entries(self, entries):
         entries_n = len(entries)
@@ -432,5 +490,25 @@ class EHentaiAPI:
             data_l.extend([refine_tags_in_dict(d) for d in j['gmetadata']])
         return data_l
 
+    async def iter_gallery_data_async(self, gid_token_tuples):
+        """yield gallery data as soon as its chunk arrives, up to `concurrency` chunks are in flight at once"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(entries):
+            async with semaphore:
+                j = await self.post_async({'method': 'gdata', 'namespace': 1, 'gidlist': entries})
+            if 'error' in j:
+                raise EHentaiError(j['error'])
+            return [refine_tags_in_dict(d) for d in j['gmetadata']]
+
+        tasks = [asyncio.ensure_future(fetch(entries)) for entries in self.split_entries(list(gid_token_tuples))]
+        try:
+            for fu in asyncio.as_completed(tasks):
+                for d in await fu:
+                    yield d
+        finally:
+            for t in tasks:
+                t.cancel()
+
     def get_gallery_data_single(self, gid, token):
         return self.post({'method': 'gdata', 'namespace': 1, 'gidlist': [[gid, token]]})
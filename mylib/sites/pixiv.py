@@ -1,12 +1,10 @@
 #!/usr/bin/env python3
-import requests
-
 from mylib.easy import *
 from mylib.easy.logging import ez_get_logger
 from mylib.ext.fstk import write_json_file, sanitize_xu
 from mylib.ext.tricks import AttributeInflection, Attreebute, width_of_int
 from mylib.web_client import HTTPResponseInspection, parse_https_url, make_requests_kwargs, DownloadPool, \
-    cookies_dict_from_file
+    cookies_dict_from_file, get_session
 
 FANBOX_DOMAIN = 'fanbox.cc'
 FANBOX_HOMEPAGE = 'https://' + FANBOX_DOMAIN
@@ -86,7 +84,7 @@ class PixivFanboxAPI:
         self.kwargs_for_requests['headers']['Origin'] = FANBOX_HOMEPAGE
 
     def get(self, url, params=None):
-        r = requests.get(url, params=params, **self.kwargs_for_requests)
+        r = get_session(url).get(url, params=params, **self.kwargs_for_requests)
         logger.debug(r.request.url)
         if r.ok:
             d = r.json()
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 """Library for website operation"""
 
+import http.cookiejar
 import json
 from concurrent.futures.thread import ThreadPoolExecutor
 from queue import Queue
@@ -10,11 +11,12 @@ from urllib.parse import urlparse, ParseResult
 import colorama
 import humanize
 import lxml.html
+import requests.adapters
 import requests.utils
+import urllib3.util
 
 import oldezpykit.stdlib.os.common
 from mylib.easy import *
-from mylib.easy.io import SubscriptableFileIO
 from mylib.easy.logging import ez_get_logger, LOG_FMT_MESSAGE_ONLY
 from mylib.easy.stdlibs.threading import ez_thread_factory
 from mylib.easy.stdlibs.typing import JSONType
@@ -28,8 +30,130 @@ USER_AGENT_FIREFOX_WIN10 = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:64.0) G
 HTMLElementTree = lxml.html.HtmlElement
 
 
+class SessionRegistry:
+    """thread-safe registry of `requests.Session`, one per scheme & host,
+    keeping connections alive in a pool and retrying on connection errors and 5xx
+
+    sessions do not store cookies from responses, so they behave like the module-level `requests.get/post`,
+    cookies are still passed per request by the callers"""
+
+    def __init__(self, pool_maxsize: int = 10, retries: int = 3, backoff_factor: float = 0.5,
+                 status_forcelist: T.Iterable[int] = (500, 502, 503, 504)):
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = tuple(status_forcelist)
+        self._sessions = {}
+        self._pool_sizes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host_key(url: str) -> T.Tuple[str, str]:
+        p = urlparse(url)
+        return p.scheme or 'https', p.netloc
+
+    def make_adapter(self, pool_maxsize: int) -> requests.adapters.HTTPAdapter:
+        retry = urllib3.util.Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                                   status_forcelist=self.status_forcelist, raise_on_status=False)
+        return requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+
+    def get(self, url: str, pool_maxsize: int = None) -> requests.Session:
+        """the session for the host of `url`, its pool grows to `pool_maxsize` if given"""
+        key = self.host_key(url)
+        pool_maxsize = max(pool_maxsize or 0, self.pool_maxsize)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                self._sessions[key] = session
+            if self._pool_sizes.get(key, 0) < pool_maxsize:
+                session.mount(f'{key[0]}://{key[1]}', self.make_adapter(pool_maxsize))
+                self._pool_sizes[key] = pool_maxsize
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._pool_sizes.clear()
+
+
+SESSIONS = SessionRegistry()
+
+
+def get_session(url: str, pool_maxsize: int = None) -> requests.Session:
+    return SESSIONS.get(url, pool_maxsize=pool_maxsize)
+
+
+class TokenBucket:
+    """token bucket rate limiter, shared by threads (`acquire`) and asyncio tasks (`acquire_async`)
+
+    every call reserves a token under a lock and then waits outside of it, so waiters never hold the lock,
+    `penalize` (on HTTP 429 or a site's own "too frequent" code) pauses all callers and halves the rate,
+    `reward` recovers it step by step"""
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = None, max_backoff: float = 300):
+        self.base_rate = self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate or rate / 16
+        self.max_backoff = max_backoff
+        self.tokens = burst
+        self.backoff = 0
+        self.last = time.monotonic()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """take a token, return how many seconds the caller must wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    async def acquire_async(self):
+        import asyncio
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def penalize(self):
+        with self._lock:
+            self.backoff = min(max(self.backoff * 2, 1 / self.rate), self.max_backoff)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + self.backoff)
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.tokens = min(self.tokens, 0)
+
+    def reward(self):
+        with self._lock:
+            self.backoff /= 2
+            self.rate = min(self.rate * 1.25, self.base_rate)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url: str, rate: float = 1, burst: int = 1) -> TokenBucket:
+    """the shared limiter for the host of `url`, `rate` and `burst` only apply when it is created"""
+    host = urlparse(url).netloc or url
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = TokenBucket(rate, burst=burst)
+        return _rate_limiters[host]
+
+
 def get_html_element_tree(url, **requests_kwargs) -> HTMLElementTree:
-    r = requests.get(url, **requests_kwargs)
+    r = get_session(url).get(url, **requests_kwargs)
     if r.ok:
         return lxml.html.document_fromstring(r.text)
     else:
@@ -215,8 +339,9 @@ def human_filesize(bytes_n: int, no_space=True):
 
 class Download:
     def __init__(self, response: requests.Response, filepath: str = None,
-                 content: bytes = None, no_content: bool = False):
-        content = b'' if no_content else content or response.content
+                 content: bytes = None, no_content: bool = False, size: int = None):
+        """`size` is given when the content was streamed to `filepath` instead of being kept in `data`"""
+        content = b'' if no_content or size is not None else content or response.content
         if not response.ok:
             raise HTTPResponseInspection(response, content)
         self.id = id(response)
@@ -225,7 +350,7 @@ class Download:
         self.reason = response.reason
         self.url = response.request.url
         self.data = content
-        self.size = len(self.data)
+        self.size = len(self.data) if size is None else size
         content_length = int(response.headers.get('Content-Length', '-1'))
         if content_length >= 0 and content_length != self.size:
             raise HTTPIncomplete(content_length, self.size)
@@ -274,7 +399,7 @@ class HTTPResponseInspection(Exception):
             self.excerpt = h.body.text_content()
         else:
             self.excerpt = None
-        ct = response.headers['content-type']
+        ct = response.headers.get('content-type', '')
         if 'json' in ct or 'javascript' in ct:
             try:
                 self.json = response.json()
@@ -306,11 +431,19 @@ class HTTPIncomplete(Exception):
 @singleton
 class DownloadPool(ThreadPoolExecutor):
     tmpfile_suffix = '.download'
+    range_map_suffix = '.ranges.json'
+    range_map_save_interval = 2.  # seconds between range map saves while downloading
 
-    def __init__(self, threads_n: int = 5, timeout: int = 30, name: str = None, show_status: bool = True):
+    def __init__(self, threads_n: int = 5, timeout: int = 30, name: str = None, show_status: bool = True,
+                 connections_per_file: int = 1, split_min_size: int = 16 * 1024 * 1024):
+        """with `connections_per_file` > 1, files of at least `split_min_size` bytes whose server accepts ranges
+        are split and downloaded over several connections, each range written at its own offset of the temp file"""
         self._max_workers: int = 0
         self.queue = Queue()
         self.timeout = timeout
+        self.connections_per_file = connections_per_file
+        self.split_min_size = split_min_size
+        self.pool_maxsize = threads_n * max(connections_per_file, 1)
         self.name = name or self.__class__.__name__
         self.logger = ez_get_logger('.'.join((__name__, self.name)), fmt=LOG_FMT_MESSAGE_ONLY)
         self.recv_size_queue = Queue()
@@ -381,17 +514,122 @@ class DownloadPool(ThreadPoolExecutor):
                 tl.pop(0)
                 nl.pop(0)
 
+    def session(self, url) -> requests.Session:
+        return get_session(url, pool_maxsize=self.pool_maxsize)
+
     def parse_head(self, url, **kwargs_for_requests):
-        head = requests.head(url, **kwargs_for_requests).headers
-        split = head.pop('accept-range') == 'bytes'
-        size = int(head.pop('content-length', '-1'))
+        kwargs = make_requests_kwargs(**kwargs_for_requests)
+        head = self.session(url).head(url, allow_redirects=True, timeout=self.timeout, **kwargs).headers
+        split = head.get('accept-ranges') == 'bytes'
+        size = int(head.get('content-length', '-1'))
         self.logger.debug('HEAD: split={}, size={}'.format(split, size))
 
         return {'split': split, 'size': size}
 
+    def plan_ranges(self, size: int) -> list:
+        """list of `[start, stop, pos]`, `pos` is where the download of the range has reached"""
+        n = max(self.connections_per_file, 1)
+        step = -(-size // n)
+        return [[start, min(start + step, size), start] for start in range(0, size, step)]
+
+    def read_range_map(self, tmpfile, size: int) -> list:
+        try:
+            d = fstk.read_json_file(tmpfile + self.range_map_suffix)
+        except (OSError, ValueError):
+            return []
+        if not d or d.get('size') != size or os.path.getsize(tmpfile) != size:
+            return []
+        return d['ranges']
+
+    def write_range_map(self, tmpfile, size: int, ranges: list):
+        """write to a temp file then replace, so a kill mid-write never leaves a corrupt range map"""
+        path = tmpfile + self.range_map_suffix
+        fstk.write_json_file(path + '.tmp', {'size': size, 'ranges': [list(r) for r in ranges]})
+        os.replace(path + '.tmp', path)
+
+    def request_range(self, url, tmpfile, r: list, on_progress: T.Callable, **kwargs_for_requests):
+        """stream `r = [start, stop, pos]` from `pos` into `tmpfile` at its own offset, advancing `r[2]`"""
+        chunk_size = 1024 * 1024
+        start, stop, pos = r
+        kwargs = make_requests_kwargs(**kwargs_for_requests)
+        kwargs['headers']['Range'] = 'bytes={}-{}'.format(pos, stop - 1)
+        with self.session(url).get(url, stream=True, timeout=self.timeout, **kwargs) as resp:
+            if resp.status_code != 206:
+                raise HTTPResponseInspection(resp, no_content=True)
+            range_start = int(re.search(r'(\d+)-(\d+)/(\d+)', resp.headers['Content-Range']).group(1))
+            if range_start != pos:
+                raise HTTPIncomplete(stop - start, pos - start)
+            with open(tmpfile, 'rb+') as f:
+                f.seek(pos)
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    chunk = chunk[:stop - r[2]]
+                    f.write(chunk)
+                    f.flush()
+                    r[2] += len(chunk)
+                    self.recv_size_queue.put((time.time(), len(chunk)))
+                    on_progress()
+                    if r[2] >= stop:
+                        break
+        if r[2] != stop:
+            raise HTTPIncomplete(stop - start, r[2] - start)
+
+    def download_ranges(self, url, tmpfile, size: int, retry, **kwargs_for_requests) -> bool:
+        """download in ranges concurrently, resuming from the range map persisted beside the temp file"""
+        ranges = self.read_range_map(tmpfile, size)
+        if ranges:
+            self.logger.info('++ resume {} ({}/{})'.format(
+                tmpfile, human_filesize(sum(pos - start for start, _, pos in ranges)), human_filesize(size)))
+        else:
+            ranges = self.plan_ranges(size)
+            with open(tmpfile, 'rb+') as f:
+                f.truncate(size)
+        lock = threading.Lock()
+        last_saved = [time.monotonic()]
+
+        def on_progress():
+            # throttled, and never makes another connection wait for the disk
+            if time.monotonic() - last_saved[0] < self.range_map_save_interval:
+                return
+            if not lock.acquire(blocking=False):
+                return
+            try:
+                self.write_range_map(tmpfile, size, ranges)
+                last_saved[0] = time.monotonic()
+            finally:
+                lock.release()
+
+        def fetch(r):
+            for cnt, x in iter_factory_retry(retry)(self.request_range, url, tmpfile, r, on_progress,
+                                                    **kwargs_for_requests):
+                if isinstance(x, Exception):
+                    self.logger.warning('! <{}> {}'.format(type(x).__name__, x))
+                    if cnt:
+                        self.logger.info('++ retry ({}) {} [{}-{}) <- {}'.format(cnt, tmpfile, r[2], r[1], url))
+                else:
+                    return True
+            return False
+
+        todo = [r for r in ranges if r[2] < r[1]]
+        ok = False
+        try:
+            with ThreadPoolExecutor(max_workers=len(todo) or 1) as executor:
+                ok = all(list(executor.map(fetch, todo)))
+        finally:
+            if ok:
+                try:
+                    os.remove(tmpfile + self.range_map_suffix)
+                except FileNotFoundError:
+                    pass
+            else:
+                with lock:
+                    self.write_range_map(tmpfile, size, ranges)
+        return ok
+
     def request_data(self, url, filepath, start=0, stop=0, **kwargs_for_requests) -> Download:
+        """stream the response body into `filepath` at its offset through one open file handle,
+        the body is never held in memory, and the written size is verified by `Download`"""
         # chunk_size = requests.models.CONTENT_CHUNK_SIZE
-        chunk_size = 4096 * 1024
+        chunk_size = 1024 * 1024
         kwargs = make_requests_kwargs(**kwargs_for_requests)
         if stop:
             kwargs['headers']['Range'] = 'bytes={}-{}'.format(start, stop - 1)
@@ -399,38 +637,44 @@ class DownloadPool(ThreadPoolExecutor):
             kwargs['headers']['Range'] = 'bytes={}-'.format(start)
         elif start < 0:
             kwargs['headers']['Range'] = 'bytes={}'.format(start)
-        r = requests.get(url, stream=True, timeout=self.timeout, **kwargs)
-        self.logger.debug(HTTPResponseInspection(r, no_content=True))
-
-        content = b''
-        stop = 0
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            self.recv_size_queue.put((time.time(), len(chunk)))
-            start = stop
-            stop = start + len(chunk)
-            content += chunk
-            total = len(content)
-            ostk.write_file_chunk(filepath, start, stop, chunk, total)
-        self.logger.debug(HTTPResponseInspection(r, content=content))
-        d = Download(r, filepath, content=content)
+        with self.session(url).get(url, stream=True, timeout=self.timeout, **kwargs) as r:
+            self.logger.debug(HTTPResponseInspection(r, no_content=True))
+            if not r.ok:
+                raise HTTPResponseInspection(r)
+            if r.status_code == 206:
+                offset, _, total = [int(i) for i in
+                                    re.search(r'(\d+)-(\d+)/(\d+)', r.headers['Content-Range']).groups()]
+            else:
+                offset, total = 0, int(r.headers.get('Content-Length', '-1'))
+            written = 0
+            with open(filepath, 'rb+') as f:
+                if total >= 0 and os.fstat(f.fileno()).st_size != total:
+                    f.truncate(total)
+                f.seek(offset)
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+                    self.recv_size_queue.put((time.time(), len(chunk)))
+                if total < 0:
+                    f.truncate(offset + written)
+            d = Download(r, filepath, size=written)
+        self.logger.debug('w {} ({}) <- {}'.format(filepath, human_filesize(written), url))
         return d
 
-    def write_file(self, dl_obj: Download):
-        url = dl_obj.url
-        file = dl_obj.file
-        start = dl_obj.start
-        stop = dl_obj.stop
-        size = dl_obj.size
-        total = dl_obj.total_size
-        with SubscriptableFileIO(file, 'rb+') as f:
-            if f.size != total:
-                f.truncate(total)
-            f[start: stop] = dl_obj.data
-            self.logger.debug('w {} ({}) <- {}'.format(file, human_filesize(size), url))
-
     def download(self, url, filepath, retry, **kwargs_for_requests):
         tmpfile = filepath + self.tmpfile_suffix
         oldezpykit.stdlib.os.common.touch(tmpfile)
+        if self.connections_per_file > 1:
+            try:
+                head = self.parse_head(url, **kwargs_for_requests)
+            except requests.RequestException as e:
+                self.logger.debug('! HEAD <{}> {}'.format(type(e).__name__, e))
+                head = {'split': False, 'size': -1}
+            if head['split'] and head['size'] >= self.split_min_size:
+                if self.download_ranges(url, tmpfile, head['size'], retry, **kwargs_for_requests):
+                    os.rename(tmpfile, filepath)
+                    self.log_file_done(filepath, head['size'])
+                return
         for cnt, x in iter_factory_retry(retry)(self.request_data, url, tmpfile, **kwargs_for_requests):
             if isinstance(x, Exception):
                 self.logger.warning('! <{}> {}'.format(type(x).__name__, x))
@@ -442,7 +686,6 @@ class DownloadPool(ThreadPoolExecutor):
                 break
         else:
             return
-        self.write_file(dl_obj)
         os.rename(tmpfile, filepath)
         self.log_file_done(filepath, dl_obj.size)
 
@@ -3,6 +3,8 @@ import enum
 import math
 from functools import partial
 
+import numpy as np
+
 from mylib.ext.PIL import open_bytes_as_image, save_image_to_bytes, enable_load_truncated_image, Image
 from mylib.easy import *
 from mylib.easy import logging
@@ -24,7 +26,16 @@ def new_cwebp_cmd():
     return r
 
 
-def cwebp_call(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ..., **kwargs):
+def cwebp_call(src: T.Union[str, bytes, 'PillowWebPEncoder'], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ...,
+               backend='cwebp', src_dimensions: T.Tuple[int, int] = None, **kwargs):
+    """backend: 'cwebp' runs the cwebp executable, 'pillow' encodes in-process via `PillowWebPEncoder`
+    src_dimensions: (width, height) of src if already known, to save opening it for `resize`"""
+    if backend == 'pillow':
+        if not isinstance(src, PillowWebPEncoder):
+            src = PillowWebPEncoder(src)
+        return src(dst, **kwargs)
+    if backend != 'cwebp':
+        raise ValueError('backend', backend)
     if isinstance(src, str):
         src_bytes = None
         src_size = os.path.getsize(src)
@@ -46,11 +57,11 @@ def cwebp_call(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.E
     resize = kwargs.pop('resize', None)
     if isinstance(resize, (int, float)) and resize > 0 and resize != 1:
         # resize = round(resize, 2)
-        if src_bytes is None:
-            src_img = Image.open(src)
+        if src_dimensions:
+            w, h = src_dimensions
         else:
-            src_img = open_bytes_as_image(src_bytes)
-        w, h = src_img.size
+            with (Image.open(src) if src_bytes is None else open_bytes_as_image(src_bytes)) as src_img:
+                w, h = src_img.size
         kwargs['resize'] = round(w * resize), round(h * resize)
         src_data['width'] = w
         src_data['height'] = h
@@ -106,11 +117,162 @@ def cwebp_call(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.E
     return rj
 
 
-def cwebp(src: T.Union[str, bytes], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ..., **kwargs):
-    rj = cwebp_call(src, dst, **kwargs)
+class PillowWebPEncoder:
+    """in-process libwebp encoder (via Pillow) for `cwebp_call(..., backend='pillow')`
+
+    the source image is decoded once and kept in memory, each call resizes (the last resized image is cached)
+    and encodes it without spawning a process, then returns a result dict in the same shape as `cwebp_call`,
+    with PSNR computed from the decoded output in YCbCr.
+    supported options: q, resize, size, m, lossless, alpha_q, metadata."""
+    resample = Image.Resampling.LANCZOS
+    size_search_steps = 7
+
+    def __init__(self, src: T.Union[str, bytes]):
+        if isinstance(src, str):
+            self.path = src
+            self.size = os.path.getsize(src)
+            open_image = partial(Image.open, src)
+        elif isinstance(src, bytes):
+            self.path = '-'
+            self.size = len(src)
+            open_image = partial(open_bytes_as_image, src)
+        else:
+            raise TypeError('src', (str, bytes))
+        try:
+            img = self._decode(open_image)
+        except OSError:
+            enable_load_truncated_image()
+            try:
+                img = self._decode(open_image)
+            except OSError as e:
+                raise CWebpInputReadError(-1, ['Input file read error', str(e)])
+        self.image = img
+        self._resized = None
+        self._ref_yuv = None
+
+    @staticmethod
+    def _decode(open_image):
+        with open_image() as img:
+            info = {k: img.info[k] for k in ('exif', 'icc_profile') if img.info.get(k)}
+            has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        img.info.update(info)
+        return img
+
+    def resized(self, size: T.Tuple[int, int]):
+        if size == self.image.size:
+            return self.image
+        if not self._resized or self._resized[0] != size:
+            self._resized = size, self.image.resize(size, self.resample, reducing_gap=3.0)
+        return self._resized[1]
+
+    def psnr(self, ref: Image.Image, out: bytes):
+        if self._ref_yuv and self._ref_yuv[0] is ref:
+            ref_yuv = self._ref_yuv[1]
+        else:
+            ref_yuv = np.asarray(ref.convert('RGB').convert('YCbCr'), dtype=np.float64)
+            self._ref_yuv = ref, ref_yuv
+        with open_bytes_as_image(out) as img:
+            out_yuv = np.asarray(img.convert('RGB').convert('YCbCr'), dtype=np.float64)
+        mse = ((ref_yuv - out_yuv) ** 2).mean(axis=(0, 1))
+        # like cwebp, weight Y over 4:2:0 subsampled U & V
+        mse_all = (4 * mse[0] + mse[1] + mse[2]) / 6
+
+        def _psnr(v):
+            return round(99. if v <= 1e-10 else 10 * math.log10(255 * 255 / v), 2)
+
+        return {'y': _psnr(mse[0]), 'u': _psnr(mse[1]), 'v': _psnr(mse[2]), 'all': _psnr(mse_all)}
+
+    def encode(self, img: Image.Image, **options):
+        return save_image_to_bytes(img, 'WEBP', **options)
+
+    def encode_to_size(self, img: Image.Image, size: int, **options):
+        # libwebp's target_size is not exposed by Pillow, bisect quality instead
+        lo, hi = 0, 100
+        out = None
+        for _ in range(self.size_search_steps):
+            q = (lo + hi + 1) // 2
+            b = self.encode(img, quality=q, **options)
+            if len(b) <= size:
+                lo, out = q, b
+            else:
+                hi = q - 1
+            if lo >= hi:
+                break
+        if out is None:
+            out = self.encode(img, quality=lo, **options)
+        return lo, out
+
+    def __call__(self, dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ..., **kwargs):
+        src_data = {'path': self.path, 'size': self.size}
+        if dst is ...:
+            dst = self.path + '.webp'
+        dst_data = {}
+        rj = {'kwargs': kwargs, 'out': b'', 'msg': [], 'cmd': None, 'code': 0, 'ok': True, 'src': src_data}
+
+        kwargs = dict(kwargs)
+        options = {'method': int(kwargs.pop('m', 4))}
+        if kwargs.pop('lossless', False):
+            options['lossless'] = True
+        if 'alpha_q' in kwargs:
+            options['alpha_quality'] = int(kwargs.pop('alpha_q'))
+        if kwargs.pop('metadata', None) in ('all', 'exif', 'icc'):
+            options.update({k: self.image.info[k] for k in ('exif', 'icc_profile') if k in self.image.info})
+        target_size = kwargs.pop('size', None)
+        q = kwargs.pop('q', None)
+        resize = kwargs.pop('resize', None)
+        if kwargs:
+            raise TypeError('unsupported options', tuple(kwargs))
+
+        w, h = self.image.size
+        if isinstance(resize, (int, float)) and resize > 0 and resize != 1:
+            src_data['width'] = w
+            src_data['height'] = h
+            dst_data['scale'] = resize
+            size = round(w * resize), round(h * resize)
+        elif isinstance(resize, (tuple, list)):
+            size = tuple(resize)
+        else:
+            size = w, h
+        if max(size) > 16383:
+            rj.update(ok=False, code=-1, msg=[
+                f'Saving file {dst}', 'Error! Cannot encode picture as WebP',
+                'Error code: 5 (BAD_DIMENSION: Bad picture dimension. Maximum width and height allowed is 16383 pixels.)'
+            ])
+            return rj
+        img = self.resized(size)
+
+        if target_size:
+            q, out = self.encode_to_size(img, int(target_size), **options)
+        else:
+            if q is not None:
+                dst_data['q'] = float(q)
+                options['quality'] = float(q)
+            out = self.encode(img, **options)
+
+        if dst == '-':
+            rj['out'] = out
+        elif dst:
+            with open(dst, 'wb') as f:
+                f.write(out)
+        if dst:
+            dst_data['path'] = dst
+        dst_data.update({
+            'width': size[0], 'height': size[1], 'size': len(out), 'psnr': self.psnr(img, out),
+            'compress': round(len(out) / self.size, 3),
+        })
+        rj['dst'] = dst_data
+        return rj
+
+
+def cwebp(src: T.Union[str, bytes, 'PillowWebPEncoder'], dst: T.Union[str, bool, T.NoneType, T.EllipsisType] = ...,
+          backend='cwebp', src_dimensions: T.Tuple[int, int] = None, **kwargs):
+    rj = cwebp_call(src, dst, backend=backend, src_dimensions=src_dimensions, **kwargs)
     try:
         return check_cwebp_call_result(rj)
     except CWebpInputReadError as e:
+        if backend != 'cwebp':
+            raise
         # if {'Corrupt JPEG data: premature end of data segment', 'Bogus marker length'} & set(rj['msg']):
         try:
             enable_load_truncated_image()
@@ -234,3 +396,157 @@ def cwebp_adaptive_gen___alpha(src, max_size: int, max_compress: float, max_q: i
     else:
         yield _cwebp(resize=scale, size=max_size)
         return
+
+
+class CWebpSearchStats:
+    """thread-safe tally of trial encodes spent per image by `cwebp_adaptive_gen`"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.encodes = 0
+        self.histogram = {}
+
+    def add(self, encodes: int):
+        with self._lock:
+            self.images += 1
+            self.encodes += encodes
+            self.histogram[encodes] = self.histogram.get(encodes, 0) + 1
+
+    def update(self, histogram: dict):
+        """merge a `histogram` (encodes -> images) tallied elsewhere, e.g. in a worker process"""
+        with self._lock:
+            for encodes, images in histogram.items():
+                self.images += images
+                self.encodes += encodes * images
+                self.histogram[encodes] = self.histogram.get(encodes, 0) + images
+
+    @property
+    def encodes_per_image(self):
+        return self.encodes / self.images if self.images else 0
+
+    def __str__(self):
+        histogram = ', '.join(f'{k}x{v}' for k, v in sorted(self.histogram.items()))
+        return f'{self.encodes} encodes for {self.images} images ' \
+               f'({self.encodes_per_image:.2f} per image; encodes x images: {histogram})'
+
+
+def _search_grid(lo: float, hi: float, step: float):
+    n = max(0, int(round((hi - lo) / step, 6)))
+    grid = [round_to(lo + i * step, step) for i in range(n + 1)]
+    if grid[-1] < hi:
+        grid.append(hi)
+    return grid
+
+
+def cwebp_adaptive_gen(src, max_size: int, max_compress: float, max_q: int, min_q: int, min_scale: float,
+                       *, q_step=5, scale_step=0.05, max_trials=8, stats: CWebpSearchStats = None, encode=None,
+                       backend='cwebp', src_dimensions: T.Tuple[int, int] = None):
+    """search the highest q, then the largest scale at that q, which fit both `max_size` and `max_compress`
+
+    yield the result of every trial encode, the last one yielded is the chosen one (it may be yielded twice).
+    after the floor probe (`min_q`, `min_scale`) the corner (`max_q`, 1) is tried, which most images fit.
+    otherwise the scale grid is searched at `max_q`, and only if no scale fits there, the q grid at `min_scale`
+    (seeded by a linear estimate from the floor probe) and then the scale grid at the chosen q.
+    each search probes the grid point predicted by a log-size model fitted to the nearest probes, and stops
+    once the model predicts the next grid point does not fit, so most images need 2~4 encodes.
+    `max_trials` caps the encodes per image, the best fitting result so far is chosen when it runs out.
+    `encode(resize=..., q=...)` defaults to `cwebp(src, '-', metadata='all', backend=backend, ...)`,
+    with the pillow backend the source is decoded only once for all the trials, with the cwebp backend
+    `src_dimensions` (if known) saves opening the source for every resized trial."""
+    if encode is None:
+        if backend == 'pillow':
+            src = PillowWebPEncoder(src)
+            src_dimensions = None
+        encode = partial(cwebp, src, '-', metadata='all', backend=backend, src_dimensions=src_dimensions)
+    trials = []
+    probes = {}
+    last = None
+
+    def _encode(**kwargs):
+        nonlocal last
+        last = encode(**kwargs)
+        trials.append(last)
+        probes[kwargs.get('q'), kwargs.get('resize')] = last
+        return last
+
+    def fits(d):
+        return d['dst']['size'] <= max_size and d['dst']['compress'] <= max_compress
+
+    def search(grid, to_x, make_kwargs, target, lo_d=None, hi_d=None, prior_slope=None, seed=None):
+        # largest value in grid which fits and its result, or (None, None) if none fits,
+        # `lo_d` is a known fitting result at grid[0], `hi_d` a known failing one at grid[-1]
+        lo, hi = (0 if lo_d else -1), (len(grid) - 1 if hi_d else len(grid))
+        known = {i: d for i, d in ((lo, lo_d), (hi, hi_d)) if d}
+        while hi - lo > 1 and len(trials) < max_trials:
+            # fit log(size) ~ x to the 2 probes nearest the open end of the bracket, or both ends of it
+            if lo in known and hi in known:
+                a, b = lo, hi
+            else:
+                nearest = sorted(known)[-2:] if lo in known else sorted(known)[:2]
+                a, b = nearest[0], nearest[-1]
+            xa, xb = to_x(grid[a]), to_x(grid[b])
+            ya, yb = math.log(known[a]['dst']['size']), math.log(known[b]['dst']['size'])
+            fitted = a != b and yb > ya
+            slope = (yb - ya) / (xb - xa) if fitted else prior_slope
+            anchor = lo if lo in known else hi
+            if slope:
+                x = to_x(grid[anchor]) + (target - math.log(known[anchor]['dst']['size'])) / slope
+            else:
+                x = math.inf if anchor == lo else -math.inf
+            candidates = [i for i in range(lo + 1, hi) if to_x(grid[i]) <= x]
+            if not candidates and not fitted:
+                # a prior alone is not trusted to give up, probe the nearest point instead
+                candidates = [lo + 1]
+            if seed is not None:
+                candidates = [i for i in range(lo + 1, hi) if to_x(grid[i]) <= seed] or candidates
+                seed = None
+            if not candidates:
+                break
+            i = candidates[-1]
+            d = known[i] = _encode(**make_kwargs(grid[i]))
+            yield d
+            if fits(d):
+                lo = i
+            else:
+                hi = i
+        return (grid[lo], known[lo]) if lo >= 0 else (None, None)
+
+    try:
+        d = floor = _encode(resize=min_scale, q=min_q)
+        yield d
+        if not fits(d):
+            if max_size / d['src']['size'] > max_compress:
+                raise SkipOverException('modest file size, keep original')
+            yield _encode(resize=min_scale, size=max_size)
+            return
+        if (min_q, min_scale) == (max_q, 1):
+            return
+        d = corner = _encode(resize=1, q=max_q)
+        yield d
+        if fits(d):
+            return
+
+        target = math.log(min(max_size, max_compress * floor['src']['size']))
+        q_grid, scale_grid = _search_grid(min_q, max_q, q_step), _search_grid(min_scale, 1, scale_step)
+        q, scale, d = max_q, min_scale, None
+        if min_scale < 1:
+            scale, d = yield from search(scale_grid, math.log, lambda v: {'resize': v, 'q': max_q}, target,
+                                         lo_d=floor if min_q == max_q else None, hi_d=corner, prior_slope=2)
+        if d is None:
+            # the linear estimate of cwebp_adaptive_gen___alpha, as if size grows 1% per q
+            q_step_by_100 = q_step / 100
+            seed = min_q + q_step * min(int((1 - floor['dst']['size'] / max_size) / q_step_by_100),
+                                        int((1 - floor['dst']['compress'] / max_compress) / q_step_by_100))
+            q, d = yield from search(q_grid, float, lambda v: {'resize': min_scale, 'q': v}, target,
+                                     lo_d=floor, hi_d=probes.get((max_q, min_scale)), seed=seed)
+            logger.debug(f'search q: {q}')
+            if min_scale < 1:
+                scale, d = yield from search(scale_grid, math.log, lambda v: {'resize': v, 'q': q}, target,
+                                             lo_d=d, hi_d=probes.get((q, 1)), prior_slope=2)
+        logger.debug(f'search scale at q={q}: {scale}')
+        if d is not last:
+            yield d
+    finally:
+        if stats is not None and trials:
+            stats.add(len(trials))
@@ -33,7 +33,9 @@ def dir_is_empty(p):
 def remove(p):
     try:
         os.remove(p)
-    except PermissionError:
+    # os.remove on a directory raises PermissionError on Windows & macOS, IsADirectoryError on Linux,
+    # but PermissionError may also be a real permission problem, then rmtree fails with NotADirectoryError
+    except (PermissionError, IsADirectoryError):
         try:
             rmtree(p)
         except NotADirectoryError:
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 import re
-import time
 
 from oldezpykit.allinone import *
 from oldezpykitext.webclient import *
+from mylib.web_client import get_session, get_rate_limiter
 
 BILIBILI_HOME_PAGE_URL = 'https://www.bilibili.com'
 BILIBILI_HEADERS = header.EzHttpHeaders().ua(header.UserAgentExamples.GOOGLE_CHROME_WINDOWS)
@@ -14,6 +14,7 @@ BILIBILI_SHORT_HOME_URL = 'https://b23.tv'
 class BilibiliWebAPIError(Exception):
     class Code:
         ACCESS_DENIED = -403
+        TOO_FREQUENT = -799
 
     def __init__(self, code, message):
         self.code = code
@@ -41,13 +42,15 @@ class BilibiliWebAPI:
         REPLY_SORT_RECENT = 0
         REPLY_SORT_POPULAR = 2
 
+    API_URL = 'https://api.bilibili.com'
+    max_retries = 3
+
     def __init__(self, cookies=None, cache_request: bool = False, request_interval=8):
         self.cookies = {}
         self.set_cookies(cookies)
         self.cache_request = cache_request
         self.request_interval = request_interval
-        # self.last_request_time = time.time() - request_interval
-        self.last_request_time = time.time()
+        self.rate_limiter = get_rate_limiter(self.API_URL, rate=1 / request_interval)
 
     def set_cookies(self, cookies):
         if not cookies:
@@ -61,15 +64,22 @@ class BilibiliWebAPI:
         return self
 
     def _request_json(self, url, **params) -> dict:
-        t = time.time()
-        t_delta = t - self.last_request_time
-        if t_delta < self.request_interval:
-            sleep(self.request_interval - t_delta)
+        for i in range(self.max_retries):
+            self.rate_limiter.acquire()
+            r = get_session(url).get(url, params=params, headers=BILIBILI_HEADERS, cookies=self.cookies)
+            if r.status_code == 429:
+                self.rate_limiter.penalize()
+                continue
+            j = r.json()
             # [Code -799] 请求过于频繁，请稍后再试
-        r = requests.get(url, params=params, headers=BILIBILI_HEADERS, cookies=self.cookies)
-        self.last_request_time = time.time()
-        j = r.json()
+            if j.get('code') == BilibiliWebAPIError.Code.TOO_FREQUENT and i < self.max_retries - 1:
+                self.rate_limiter.penalize()
+                continue
+            break
+        else:
+            r.raise_for_status()
         check_response_json(j)
+        self.rate_limiter.reward()
         try:
             return j['data']
         except KeyError:
@@ -88,7 +98,7 @@ class BilibiliWebAPI:
     @functools.lru_cache()
     def clarify_uri(self, uri: str):
         if uri.startswith(BILIBILI_SHORT_HOME_URL):
-            r = requests.get(uri)
+            r = get_session(uri).get(uri)
             uri = r.url
         return uri
 